@@ -1,9 +1,15 @@
 """
 Account management for the Telegram bot
 """
+import asyncio
 import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from database import AsyncDatabase, Database, forget_schema_check
 import config
 
 logger = logging.getLogger(__name__)
@@ -12,9 +18,22 @@ logger = logging.getLogger(__name__)
 class AccountManager:
     """Manages user accounts"""
     
-    def __init__(self):
+    def __init__(self, db_cache_size: int = config.DB_CACHE_SIZE):
         self.accounts_dir = config.ACCOUNTS_DIR
         self.accounts_dir.mkdir(exist_ok=True)
+        
+        # In-memory index of account directories
+        self._accounts: Set[str] = set()
+        self._accounts_mtime: Optional[float] = None
+        self._accounts_checked_at = 0.0
+        self.refresh_accounts(force=True)
+        
+        # LRU cache of open account databases
+        self.db_cache_size = db_cache_size
+        self._databases: "OrderedDict[str, Database]" = OrderedDict()
+        self._pinned: Dict[str, int] = {}
+        self._db_lock = threading.RLock()
+        self.db_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
     
     def get_account_path(self, account_id: str) -> Path:
         """Get account directory path"""
@@ -29,31 +48,209 @@ class AccountManager:
         sessions_path = account_path / config.SESSION_DIR_NAME
         sessions_path.mkdir(exist_ok=True)
         
+        self._accounts.add(account_id)
         logger.info(f"Created account: {account_id}")
         return account_path
     
     def account_exists(self, account_id: str) -> bool:
         """Check if account exists"""
-        return self.get_account_path(account_id).exists()
+        self.refresh_accounts()
+        return account_id in self._accounts
     
     def get_all_accounts(self) -> List[str]:
         """Get list of all account IDs"""
+        self.refresh_accounts()
+        return sorted(self._accounts)
+    
+    def refresh_accounts(self, force: bool = False):
+        """Rescan the accounts directory if it changed out-of-band
+        
+        The index is kept up to date by create_account/delete_account; the
+        directory mtime is only checked every ACCOUNT_INDEX_REFRESH_INTERVAL
+        seconds (never when it is 0) to pick up accounts added by hand.
+        """
+        now = time.monotonic()
+        if not force:
+            interval = config.ACCOUNT_INDEX_REFRESH_INTERVAL
+            if interval <= 0 or now - self._accounts_checked_at < interval:
+                return
+        self._accounts_checked_at = now
+        
         try:
-            return [
-                d.name for d in self.accounts_dir.iterdir() 
+            mtime = self.accounts_dir.stat().st_mtime
+            if not force and mtime == self._accounts_mtime:
+                return
+            self._accounts = {
+                d.name for d in self.accounts_dir.iterdir()
                 if d.is_dir() and not d.name.startswith('.')
-            ]
+            }
+            self._accounts_mtime = mtime
         except Exception as e:
             logger.error(f"Error getting accounts: {e}")
-            return []
+    
+    # Database cache
+    def get_database(self, account_id: str) -> Database:
+        """Get the cached Database for an account, opening it if needed"""
+        with self._db_lock:
+            db, evicted = self._lookup_database(account_id)
+        self._close_evicted(evicted)
+        return db
+    
+    def get_async_database(self, account_id: str) -> AsyncDatabase:
+        """Get an account database as an awaitable facade
+        
+        The facade looks the database up in the cache on every call, so it
+        stays valid after an eviction. Use pinned_database() to keep one
+        instance open across a block of calls.
+        """
+        return AsyncDatabase(lambda: self.get_database(account_id))
+    
+    @contextmanager
+    def pinned_database(self, account_id: str) -> Iterator[AsyncDatabase]:
+        """Pin an account database for the duration of a with block"""
+        db = self.pin_database(account_id)
+        try:
+            yield db.aio
+        finally:
+            self.unpin_database(account_id)
+    
+    def pin_database(self, account_id: str) -> Database:
+        """Get an account database and protect it from eviction until unpinned"""
+        with self._db_lock:
+            db, evicted = self._lookup_database(account_id)
+            self._pinned[account_id] = self._pinned.get(account_id, 0) + 1
+        self._close_evicted(evicted)
+        return db
+    
+    def unpin_database(self, account_id: str):
+        """Release a pin taken with pin_database"""
+        with self._db_lock:
+            count = self._pinned.get(account_id, 0) - 1
+            if count > 0:
+                self._pinned[account_id] = count
+            else:
+                self._pinned.pop(account_id, None)
+            evicted = self._evict_databases()
+        self._close_evicted(evicted)
+    
+    def _lookup_database(self, account_id: str) -> Tuple[Database, List[Database]]:
+        """Get or open an account database, with _db_lock held
+        
+        Returns the database and the ones evicted to make room for it.
+        """
+        db = self._databases.get(account_id)
+        if db is not None:
+            self._databases.move_to_end(account_id)
+            self.db_cache_stats['hits'] += 1
+            return db, []
+        
+        self.db_cache_stats['misses'] += 1
+        db = Database(self.get_account_path(account_id))
+        self._databases[account_id] = db
+        return db, self._evict_databases()
+    
+    def _evict_databases(self) -> List[Database]:
+        """Drop least recently used databases beyond the cache size
+        
+        Called with _db_lock held; the caller closes the returned databases
+        with _close_evicted() after releasing it.
+        """
+        evicted = []
+        excess = len(self._databases) - self.db_cache_size
+        for account_id in list(self._databases):
+            if excess <= 0:
+                break
+            if account_id in self._pinned:
+                continue
+            evicted.append(self._databases.pop(account_id))
+            self.db_cache_stats['evictions'] += 1
+            excess -= 1
+        return evicted
+    
+    @staticmethod
+    def _close_evicted(databases: List[Database]):
+        """Close evicted databases without waiting for their queued writes"""
+        for db in databases:
+            db.close(wait=False)
+    
+    def close_database(self, account_id: str):
+        """Close and forget an account database"""
+        with self._db_lock:
+            db = self._databases.pop(account_id, None)
+            self._pinned.pop(account_id, None)
+        if db is not None:
+            db.close()
+    
+    def close_all_databases(self):
+        """Close every cached database"""
+        with self._db_lock:
+            databases = list(self._databases.values())
+            self._databases.clear()
+            self._pinned.clear()
+        # Worker threads finish queued writes before the interpreter exits
+        self._close_evicted(databases)
+    
+    async def check_database_profiles(self) -> Dict[str, dict]:
+        """Log the pragma profile each account database actually runs with
+        
+        Each database is opened and checked on a worker thread, so the event
+        loop keeps handling updates meanwhile.
+        """
+        loop = asyncio.get_running_loop()
+        reports = {}
+        for account_id in self.get_all_accounts():
+            report = await loop.run_in_executor(None, self.check_database_profile, account_id)
+            if report is not None:
+                reports[account_id] = report
+        return reports
+    
+    def check_database_profile(self, account_id: str) -> Optional[Dict[str, dict]]:
+        """Log the pragma profile of one account database and return its report"""
+        try:
+            # Pinned so a concurrent eviction can't close it mid-report
+            db = self.pin_database(account_id)
+        except Exception as e:
+            logger.error(f"Error checking database profile for {account_id}: {e}")
+            return None
+        try:
+            report = db.get_pragma_report()
+        except Exception as e:
+            logger.error(f"Error checking database profile for {account_id}: {e}")
+            return None
+        finally:
+            self.unpin_database(account_id)
+        
+        summary = ', '.join(f"{name}={info['actual']}" for name, info in report.items())
+        mismatched = [name for name, info in report.items() if not info['ok']]
+        if mismatched:
+            logger.warning(
+                f"Database {account_id} does not match profile "
+                f"'{config.DB_PRAGMA_PROFILE}' ({', '.join(mismatched)}): {summary}"
+            )
+        else:
+            logger.info(f"Database {account_id}: {summary}")
+        return report
+    
+    def get_db_cache_stats(self) -> dict:
+        """Get database cache counters"""
+        with self._db_lock:
+            return {
+                **self.db_cache_stats,
+                'open': len(self._databases),
+                'pinned': len(self._pinned),
+                'capacity': self.db_cache_size
+            }
     
     def delete_account(self, account_id: str) -> bool:
         """Delete an account"""
         try:
             import shutil
+            self.close_database(account_id)
             account_path = self.get_account_path(account_id)
             if account_path.exists():
                 shutil.rmtree(account_path)
+                forget_schema_check(account_path / config.DB_NAME)
+                self._accounts.discard(account_id)
                 logger.info(f"Deleted account: {account_id}")
                 return True
             return False
@@ -3,10 +3,14 @@ Automatic message sender for scheduled messages
 """
 import asyncio
 import logging
-from typing import Dict
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
 from pathlib import Path
-from database import Database
+from database import AsyncDatabase, SendBatch
+from metrics import SendMetrics
+from scheduler import SendScheduler
 from session_manager import SessionManager
+from session_pool import SessionPool
 import config
 
 logger = logging.getLogger(__name__)
@@ -17,104 +21,381 @@ class AutoSender:
     
     def __init__(self, account_manager):
         self.account_manager = account_manager
-        self.active_sessions: Dict[str, SessionManager] = {}
+        self.sessions = SessionPool(self.connect_session)
+        self.prewarm_timers: Dict[str, asyncio.TimerHandle] = {}
+        self.scheduler = SendScheduler()
+        self.account_semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_ACCOUNTS)
+        self.account_tasks: Dict[str, asyncio.Task] = {}
+        # Message ids popped off the scheduler for each account's current round
+        self._popped: Dict[str, Set[int]] = {}
+        # Flood wait deadlines per account, and the groups each interrupted
+        # message still has to reach once the wait is over
+        self.paused_until: Dict[str, float] = {}
+        self._pending_groups: Dict[Tuple[str, int], List[int]] = {}
+        # Called with a text for the admin, e.g. when groups get disabled
+        self.notifier: Optional[Callable[[str], Awaitable[None]]] = None
+        self.metrics = SendMetrics()
+        self.watch_task: Optional[asyncio.Task] = None
         self.running = False
     
     async def start(self):
         """Start the auto-send loop"""
         self.running = True
-        logger.info("Auto-sender started")
+        self.sessions.start()
+        await self.load_schedule()
+        if config.ACCOUNT_INDEX_REFRESH_INTERVAL > 0:
+            self.watch_task = asyncio.create_task(self.watch_accounts())
+        logger.info(f"Auto-sender started ({len(self.scheduler)} messages scheduled)")
         
         while self.running:
             try:
-                await self.process_all_accounts()
-                await asyncio.sleep(config.AUTO_SEND_CHECK_INTERVAL)
+                await self.scheduler.wait_for_due()
+                due = self.scheduler.pop_due()
+                if due and self.running:
+                    self.dispatch_accounts(due)
             except Exception as e:
                 logger.error(f"Error in auto-send loop: {e}")
-                await asyncio.sleep(60)
+                await asyncio.sleep(config.AUTO_SEND_RETRY_DELAY)
     
     def stop(self):
         """Stop the auto-send loop"""
         self.running = False
+        self.scheduler.wake()
+        for task in list(self.account_tasks.values()):
+            task.cancel()
+        if self.watch_task:
+            self.watch_task.cancel()
+        for timer in self.prewarm_timers.values():
+            timer.cancel()
+        self.prewarm_timers.clear()
         logger.info("Auto-sender stopped")
     
-    async def process_all_accounts(self):
-        """Process all accounts for pending messages"""
-        accounts = self.account_manager.get_all_accounts()
+    async def load_schedule(self):
+        """Load the deadlines of every account into the scheduler"""
+        for account_id in self.account_manager.get_all_accounts():
+            await self.refresh_schedule(account_id)
+    
+    async def watch_accounts(self):
+        """Pick up accounts added or removed outside the bot"""
+        known = set(self.account_manager.get_all_accounts())
+        while self.running:
+            await asyncio.sleep(config.ACCOUNT_INDEX_REFRESH_INTERVAL)
+            accounts = set(self.account_manager.get_all_accounts())
+            for account_id in accounts - known:
+                logger.info(f"Found new account {account_id}")
+                await self.refresh_schedule(account_id)
+            for account_id in known - accounts:
+                self.scheduler.unschedule_account(account_id)
+                self.schedule_prewarm(account_id, None)
+                await self.sessions.discard(account_id)
+            known = accounts
+    
+    async def refresh_schedule(self, account_id: str, retry_ids: Iterable[int] = (),
+                               popped: Iterable[int] = ()):
+        """Reload an account's deadlines after its messages changed
+        
+        Messages in retry_ids that are still due (a round tried them but
+        could not send them) are retried after AUTO_SEND_RETRY_DELAY instead
+        of immediately; other due messages keep their deadline. While the
+        account waits out a flood wait, every due message waits for its end.
+        If the reload fails, the account's remaining deadlines are kept and
+        the popped message ids (already taken off the scheduler for the
+        round) are retried after AUTO_SEND_RETRY_DELAY.
+        """
+        try:
+            with self.account_manager.pinned_database(account_id) as db:
+                auto_send = (await db.get_settings()).get('auto_send', True)
+                schedule = await db.get_message_schedule() if auto_send else []
+        except Exception as e:
+            logger.error(f"Error loading schedule for account {account_id}: {e}")
+            schedule = None
+        
+        if schedule is None:
+            retry_at = self._retry_at(account_id)
+            for message_id in popped:
+                self.scheduler.schedule(account_id, message_id, retry_at)
+            return
         
-        for account_id in accounts:
+        if not auto_send:
+            self.scheduler.unschedule_account(account_id)
+            self.schedule_prewarm(account_id, None)
+            return
+        
+        retry_ids = set(retry_ids)
+        paused = self.is_paused(account_id)
+        if retry_ids or paused:
+            now = int(time.time())
+            retry_at = self._retry_at(account_id)
+            schedule = [
+                (message_id,
+                 retry_at if next_send <= now and (paused or message_id in retry_ids)
+                 else next_send)
+                for message_id, next_send in schedule
+            ]
+        self.scheduler.set_account_schedule(account_id, schedule)
+        self.schedule_prewarm(
+            account_id, min((next_send for _, next_send in schedule), default=None)
+        )
+    
+    def _retry_at(self, account_id: str) -> int:
+        """Deadline for retrying messages a round couldn't send"""
+        if self.is_paused(account_id):
+            return int(self.paused_until[account_id]) + 1
+        return int(time.time()) + config.AUTO_SEND_RETRY_DELAY
+    
+    def is_paused(self, account_id: str) -> bool:
+        """Check if an account is waiting out a flood wait"""
+        paused_until = self.paused_until.get(account_id)
+        if paused_until is None:
+            return False
+        if time.time() < paused_until:
+            return True
+        del self.paused_until[account_id]
+        return False
+    
+    def _record_pause(self, account_id: str, session_manager: SessionManager):
+        """Remember a flood wait the session ran into"""
+        if session_manager.is_paused():
+            self.paused_until[account_id] = session_manager.paused_until
+            logger.warning(
+                f"Account {account_id} paused for "
+                f"{session_manager.paused_until - time.time():.0f}s by flood wait"
+            )
+    
+    def schedule_prewarm(self, account_id: str, next_send: Optional[int]):
+        """Connect an account's session SESSION_PREWARM_SECONDS before its next deadline"""
+        timer = self.prewarm_timers.pop(account_id, None)
+        if timer:
+            timer.cancel()
+        if next_send is None or config.SESSION_PREWARM_SECONDS <= 0:
+            return
+        
+        delay = next_send - config.SESSION_PREWARM_SECONDS - time.time()
+        if delay <= 0:
+            # Too close to bother; the round connects on its own
+            return
+        self.prewarm_timers[account_id] = asyncio.get_running_loop().call_later(
+            delay, self._start_prewarm, account_id
+        )
+    
+    def _start_prewarm(self, account_id: str):
+        """Timer callback for schedule_prewarm"""
+        self.prewarm_timers.pop(account_id, None)
+        if self.running:
+            asyncio.create_task(self.sessions.prewarm(account_id))
+    
+    def dispatch_accounts(self, due: Dict[str, List[int]]):
+        """Start a processing task for each due account that isn't already running"""
+        for account_id, message_ids in due.items():
+            self._popped.setdefault(account_id, set()).update(message_ids)
+            if account_id in self.account_tasks:
+                # The running round reloads the account's schedule when it ends
+                continue
+            task = asyncio.create_task(self._run_account(account_id))
+            self.account_tasks[account_id] = task
+            task.add_done_callback(
+                lambda _, account_id=account_id: self.account_tasks.pop(account_id, None)
+            )
+    
+    async def _run_account(self, account_id: str):
+        """Process one account, limited to MAX_CONCURRENT_ACCOUNTS at a time"""
+        async with self.account_semaphore:
+            # Messages the round picked up; only these get the retry delay
+            attempted: Set[int] = set()
             try:
-                await self.process_account(account_id)
+                await self.process_account(account_id, attempted)
             except Exception as e:
                 logger.error(f"Error processing account {account_id}: {e}")
+                # Don't retry a failing round right away
+                attempted.update(self._popped.get(account_id, ()))
+            finally:
+                # Ids popped while the round ran are restored by this reload too
+                await self.refresh_schedule(account_id, retry_ids=attempted,
+                                            popped=self._popped.get(account_id, ()))
+                self._popped.pop(account_id, None)
     
-    async def process_account(self, account_id: str):
-        """Process a single account"""
-        account_path = self.account_manager.get_account_path(account_id)
-        db = Database(account_path)
+    async def process_account(self, account_id: str, attempted: Optional[Set[int]] = None):
+        """Process a single account
         
+        The ids of the pending messages the round picks up are added to
+        attempted, whether or not they could be sent.
+        """
+        db = self.account_manager.pin_database(account_id)
+        self.sessions.hold(account_id)
+        try:
+            await self._process_account(account_id, db.aio, attempted)
+        finally:
+            self.sessions.release(account_id)
+            self.account_manager.unpin_database(account_id)
+    
+    async def _process_account(self, account_id: str, db: AsyncDatabase,
+                               attempted: Optional[Set[int]] = None):
+        """Send pending messages for an account using its pinned database"""
         # Check if auto-send is enabled
-        auto_send = db.get_setting('auto_send', '1')
-        if auto_send != '1':
+        settings = await db.get_settings()
+        if not settings.get('auto_send', True):
+            return
+        
+        if self.is_paused(account_id):
             return
         
         # Get pending messages
-        pending_messages = db.get_pending_messages()
+        pending_messages = await db.get_pending_messages()
         if not pending_messages:
             return
+        if attempted is not None:
+            attempted.update(message[0] for message in pending_messages)
         
         # Get active groups
-        groups = db.get_groups(active_only=True)
+        groups = await db.get_groups(active_only=True)
         if not groups:
             logger.warning(f"No active groups for account {account_id}")
             return
         
         # Initialize session if needed
-        session_manager = await self.get_or_create_session(account_id, db)
+        session_manager = await self.get_or_create_session(account_id)
         if not session_manager or not session_manager.is_connected():
             logger.warning(f"Session not available for account {account_id}")
             return
+        groups = await self.backfill_peers(db, session_manager, groups)
         
         # Send messages
-        delay = int(db.get_setting('send_delay', str(config.MESSAGE_DELAY_BETWEEN_GROUPS)))
+        delay = settings.get('send_delay', config.MESSAGE_DELAY_BETWEEN_GROUPS)
+        
+        self.metrics.rounds += 1
+        batch = SendBatch()
+        budget = self.round_budget(len(pending_messages), len(groups), delay)
+        try:
+            await asyncio.wait_for(
+                self._send_round(account_id, pending_messages, groups,
+                                 session_manager, batch, delay),
+                budget
+            )
+        except asyncio.TimeoutError:
+            self.handle_stuck_round(account_id, f"exceeded {budget:.0f}s")
+        finally:
+            # Write the whole round's bookkeeping in one transaction
+            await db.flush_batch(batch)
+            await self.notify_deactivated(account_id, batch)
+    
+    async def _send_round(self, account_id: str, messages: list, groups: list,
+                          session_manager: SessionManager, batch: SendBatch, delay: int):
+        """Send each message to all groups until done or flood-waited"""
+        for message in messages:
+            await self.send_message(account_id, message, groups, session_manager, batch, delay)
+            if session_manager.is_paused():
+                # The rest waits for the flood wait; other accounts keep going
+                self._record_pause(account_id, session_manager)
+                break
+            if session_manager.is_stalled():
+                self.handle_stuck_round(
+                    account_id, f"{session_manager.consecutive_timeouts} sends timed out in a row"
+                )
+                break
+    
+    async def backfill_peers(self, db: AsyncDatabase, session_manager: SessionManager,
+                             groups: list) -> list:
+        """Resolve and store the peers of groups added before peers were recorded
         
-        for message in pending_messages:
-            await self.send_message(account_id, message, groups, session_manager, db, delay)
+        Each such group is resolved once; the returned rows carry the stored
+        peer, so its sends don't go through Telethon's resolution again.
+        """
+        updated = []
+        for group in groups:
+            if group[9] is None:  # peer_type column
+                peer = await session_manager.resolve_peer(group[3])
+                if peer and await db.update_group_peer(group[0], peer['access_hash'],
+                                                       peer['peer_type']):
+                    group = group[:8] + (peer['access_hash'], peer['peer_type']) + group[10:]
+            updated.append(group)
+        return updated
+    
+    @staticmethod
+    def round_budget(messages: int, groups: int, delay: int) -> float:
+        """Expected duration of a round plus slack: every send paced and reasonably fast"""
+        return (messages * groups * (delay + config.ROUND_SEND_ALLOWANCE)
+                + config.ROUND_WATCHDOG_SLACK)
+    
+    def handle_stuck_round(self, account_id: str, reason: str):
+        """Reconnect the session of a round that stalled or the watchdog cancelled"""
+        self.metrics.stuck_rounds += 1
+        logger.warning(f"Round for account {account_id} is stuck ({reason}), reconnecting session")
+        # Dropped once the round (and any Send Now) releases it
+        self.sessions.recycle(account_id)
     
     async def send_message(self, account_id: str, message: tuple, groups: list,
-                          session_manager: SessionManager, db: Database, delay: int):
+                          session_manager: SessionManager, batch: SendBatch, delay: int):
         """Send a single message to all groups"""
         message_id = message[0]
         message_text = message[1]
+        key = (account_id, message_id)
         
+        # Resume an interrupted message with the groups it hadn't reached
+        remaining = self._pending_groups.get(key)
+        if remaining is not None:
+            remaining = set(remaining)
+            groups = [group for group in groups if group[0] in remaining]
+        
+        results = []
+        completed = False
         try:
             logger.info(f"Sending message {message_id} from account {account_id}")
             
-            successful, failed = await session_manager.send_to_multiple_groups(
-                message_text, groups, delay
-            )
-            
-            # Update message and statistics
-            db.update_message_after_send(message_id)
-            db.update_stats(successful + failed, successful, failed)
-            
-            logger.info(
-                f"Message {message_id} sent: {successful} successful, {failed} failed"
-            )
+            await session_manager.send_to_multiple_groups(message_text, groups, delay, results)
+            completed = not (session_manager.is_paused() or session_manager.is_stalled())
         except Exception as e:
             logger.error(f"Error sending message {message_id}: {e}")
+        finally:
+            # Also runs when the watchdog cancels the round, so groups that
+            # were already reached are recorded and not sent to again
+            self._record_results(account_id, message_id, groups, results, batch, completed)
     
-    async def get_or_create_session(self, account_id: str, 
-                                   db: Database) -> SessionManager:
+    def _record_results(self, account_id: str, message_id: int, groups: list,
+                        results: list, batch: SendBatch, completed: bool):
+        """Add a message's results to the round's batch"""
+        key = (account_id, message_id)
+        if completed:
+            self._pending_groups.pop(key, None)
+            batch.message_sent(message_id)
+        else:
+            reached = {result[0] for result in results}
+            self._pending_groups[key] = [
+                group[0] for group in groups if group[0] not in reached
+            ]
+        
+        successful = sum(1 for result in results if result[3] is None)
+        failed = len(results) - successful
+        batch.add_stats(successful + failed, successful, failed)
+        for group_id, sent_at, latency_ms, error_code in results:
+            batch.add_delivery(message_id, group_id, sent_at, latency_ms, error_code,
+                               SessionManager.is_permanent_error(error_code))
+        
+        logger.info(
+            f"Message {message_id} sent: {successful} successful, {failed} failed"
+        )
+    
+    async def notify_deactivated(self, account_id: str, batch: SendBatch):
+        """Tell the admin about groups flush_batch disabled"""
+        if not batch.deactivated_groups or not self.notifier:
+            return
+        
+        text = f"⚠️ **Groups disabled for account {account_id}**\n\n"
+        for group_id, title, last_error in batch.deactivated_groups:
+            text += f"• {title or group_id} ({last_error})\n"
+        text += "\nAdd a group again to re-enable it once the problem is fixed."
+        try:
+            await self.notifier(text)
+        except Exception as e:
+            logger.error(f"Error notifying admin: {e}")
+    
+    async def get_or_create_session(self, account_id: str) -> Optional[SessionManager]:
         """Get or create a session manager for an account"""
-        # Check if session already exists
-        if account_id in self.active_sessions:
-            session_manager = self.active_sessions[account_id]
-            if session_manager.is_connected():
-                return session_manager
-        
-        # Create new session
-        user_data = db.get_user()
+        return await self.sessions.get(account_id)
+    
+    async def connect_session(self, account_id: str) -> Optional[SessionManager]:
+        """Connect a new session manager from the account's saved login"""
+        db = self.account_manager.get_async_database(account_id)
+        user_data = await db.get_user()
         if not user_data:
             return None
         
@@ -123,65 +404,88 @@ class AutoSender:
         session_manager = SessionManager(account_path)
         
         if await session_manager.initialize_from_db(session_file):
-            self.active_sessions[account_id] = session_manager
             return session_manager
         
         return None
     
     async def send_now(self, account_id: str) -> dict:
         """Send all messages immediately"""
-        account_path = self.account_manager.get_account_path(account_id)
-        db = Database(account_path)
-        
+        db = self.account_manager.pin_database(account_id)
+        self.sessions.hold(account_id)
+        try:
+            return await self._send_now(account_id, db.aio)
+        finally:
+            self.sessions.release(account_id)
+            self.account_manager.unpin_database(account_id)
+    
+    async def _send_now(self, account_id: str, db: AsyncDatabase) -> dict:
+        """Send all active messages of an account using its pinned database"""
         # Get all active messages
-        messages = db.get_messages(active_only=True)
+        messages = await db.get_messages(active_only=True)
         if not messages:
             return {'success': False, 'message': 'No active messages'}
         
         # Get active groups
-        groups = db.get_groups(active_only=True)
+        groups = await db.get_groups(active_only=True)
         if not groups:
             return {'success': False, 'message': 'No active groups'}
         
+        if self.is_paused(account_id):
+            seconds = self.paused_until[account_id] - time.time()
+            return {'success': False, 'message': f'Flood wait, try again in {seconds:.0f}s'}
+        
         # Initialize session
-        session_manager = await self.get_or_create_session(account_id, db)
+        session_manager = await self.get_or_create_session(account_id)
         if not session_manager:
             return {'success': False, 'message': 'Session not available'}
+        groups = await self.backfill_peers(db, session_manager, groups)
         
         # Send all messages
-        delay = int(db.get_setting('send_delay', str(config.MESSAGE_DELAY_BETWEEN_GROUPS)))
+        delay = (await db.get_settings()).get('send_delay', config.MESSAGE_DELAY_BETWEEN_GROUPS)
         total_successful = 0
         total_failed = 0
+        batch = SendBatch()
         
-        for message in messages:
-            message_text = message[1]
-            successful, failed = await session_manager.send_to_multiple_groups(
-                message_text, groups, delay
-            )
-            total_successful += successful
-            total_failed += failed
-        
-        # Update statistics
-        db.update_stats(total_successful + total_failed, total_successful, total_failed)
+        try:
+            for message in messages:
+                message_text = message[1]
+                results = []
+                successful, failed = await session_manager.send_to_multiple_groups(
+                    message_text, groups, delay, results
+                )
+                total_successful += successful
+                total_failed += failed
+                for group_id, sent_at, latency_ms, error_code in results:
+                    batch.add_delivery(message[0], group_id, sent_at, latency_ms, error_code,
+                                       SessionManager.is_permanent_error(error_code))
+                if session_manager.is_paused():
+                    self._record_pause(account_id, session_manager)
+                    break
+                if session_manager.is_stalled():
+                    self.handle_stuck_round(account_id, "sends keep timing out")
+                    break
+        finally:
+            # Update statistics
+            batch.add_stats(total_successful + total_failed, total_successful, total_failed)
+            await db.flush_batch(batch)
+            await self.notify_deactivated(account_id, batch)
         
         return {
             'success': True,
             'successful': total_successful,
             'failed': total_failed,
             'messages_count': len(messages),
-            'groups_count': len(groups)
+            'groups_count': len(groups),
+            'paused_until': self.paused_until.get(account_id)
         }
     
     async def cleanup_session(self, account_id: str):
         """Clean up a session"""
-        if account_id in self.active_sessions:
-            session_manager = self.active_sessions[account_id]
-            await session_manager.disconnect()
-            del self.active_sessions[account_id]
+        if account_id in self.sessions.sessions:
+            await self.sessions.discard(account_id)
             logger.info(f"Cleaned up session for {account_id}")
     
     async def cleanup_all_sessions(self):
         """Clean up all sessions"""
-        for account_id in list(self.active_sessions.keys()):
-            await self.cleanup_session(account_id)
+        await self.sessions.close_all()
         logger.info("All sessions cleaned up")
@@ -0,0 +1,82 @@
+"""
+Benchmark the pending messages query with and without its index
+
+Usage: python benchmarks/bench_scheduler_queries.py [rows ...]
+
+Only migration 2 is applied between the two timings.
+"""
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from database import apply_migrations  # noqa: E402
+
+PENDING_QUERY = '''
+    SELECT * FROM messages
+    WHERE is_active = 1 AND next_send <= ?
+'''
+
+DEFAULT_ROWS = (10_000, 100_000)
+REPEATS = 50
+
+
+def populate(conn: sqlite3.Connection, rows: int):
+    """Fill messages with a realistic mix of rows"""
+    now = int(time.time())
+    messages = []
+    for i in range(rows):
+        # ~1% of messages are due, ~20% are inactive
+        if random.random() < 0.01:
+            next_send = now - random.randint(1, 60) * 60
+        else:
+            next_send = now + random.randint(1, 60 * 24) * 60
+        messages.append((f"message {i}", int(random.random() >= 0.2), next_send))
+
+    conn.executemany(
+        'INSERT INTO messages (message_text, is_active, next_send) VALUES (?, ?, ?)',
+        messages
+    )
+    conn.commit()
+    conn.execute('ANALYZE')
+
+
+def time_query(conn: sqlite3.Connection, query: str, params: tuple = ()) -> float:
+    """Average wall time of a query in milliseconds"""
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        conn.execute(query, params).fetchall()
+    return (time.perf_counter() - start) * 1000 / REPEATS
+
+
+def run(rows: int, work_dir: Path):
+    """Time the query before and after the index migration"""
+    conn = sqlite3.connect(work_dir / f"bench_{rows}.db")
+    apply_migrations(conn, target_version=1)
+    populate(conn, rows)
+
+    now = (int(time.time()),)
+    before = time_query(conn, PENDING_QUERY, now)
+    apply_migrations(conn, target_version=2)
+    conn.execute('ANALYZE')
+    after = time_query(conn, PENDING_QUERY, now)
+    conn.close()
+
+    print(f"{rows:>8} rows  get_pending_messages  before {before:8.3f} ms  after {after:8.3f} ms  "
+          f"x{before / after if after else float('inf'):.1f}")
+
+
+def main():
+    rows_list = [int(arg) for arg in sys.argv[1:]] or DEFAULT_ROWS
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in rows_list:
+            run(rows, Path(tmp))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,9 @@ BASE_DIR = Path(__file__).parent
 ACCOUNTS_DIR = BASE_DIR / 'accounts'
 LOGS_DIR = BASE_DIR / 'logs'
 
+# Seconds between checks of ACCOUNTS_DIR for accounts added by hand (0 = never)
+ACCOUNT_INDEX_REFRESH_INTERVAL = 300
+
 # Create directories if they don't exist
 ACCOUNTS_DIR.mkdir(exist_ok=True)
 LOGS_DIR.mkdir(exist_ok=True)
@@ -26,8 +29,28 @@ DEFAULT_MIN_INTERVAL = 30  # minutes
 DEFAULT_MAX_INTERVAL = 60  # minutes
 
 # Auto-send settings
-AUTO_SEND_CHECK_INTERVAL = 60  # seconds
+AUTO_SEND_RETRY_DELAY = 60  # seconds before retrying a message that could not be sent
 MESSAGE_DELAY_BETWEEN_GROUPS = 2  # seconds
+MAX_CONCURRENT_ACCOUNTS = 10  # accounts sending at the same time
+SEND_TIMEOUT = 30  # seconds a single send may take before it counts as failed
+RPC_TIMEOUT = 30  # seconds a connect, join or lookup request may take
+SEND_MAX_CONSECUTIVE_TIMEOUTS = 3  # timed-out sends in a row before the session is reconnected (0 = never)
+ROUND_SEND_ALLOWANCE = 5  # seconds a send is expected to take, for the round watchdog
+ROUND_WATCHDOG_SLACK = 60  # seconds added to a round's expected duration before it is cancelled
+GROUP_MAX_PERMANENT_FAILURES = 3  # consecutive permanent errors before a group is disabled (0 = never)
+
+# Session pool settings
+SESSION_POOL_MAX_LIVE = 50  # connected Telegram clients kept at once
+SESSION_IDLE_TIMEOUT = 900  # seconds before an unused client is disconnected (0 = never)
+SESSION_PREWARM_SECONDS = 30  # connect this long before an account's next send (0 = off)
+SESSION_AUTH_CHECK_TTL = 600  # seconds a verified authorization is trusted
+SESSION_RECONNECT_BACKOFF_BASE = 2  # seconds, doubled after each failed reconnect
+SESSION_RECONNECT_BACKOFF_MAX = 300  # seconds
+
+# Metrics settings
+LOOP_LAG_INTERVAL = 1.0  # seconds between event loop lag samples
+LOOP_LAG_WARN_THRESHOLD = 0.1  # seconds of lag that get logged
+METRICS_LOG_INTERVAL = 300  # seconds between metrics log lines (0 = off)
 
 # Logging settings
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -35,6 +58,25 @@ LOG_FILE = LOGS_DIR / 'bot.log'
 
 # Database settings
 DB_NAME = 'bot.db'
+DB_CACHE_SIZE = 64  # open account databases kept by AccountManager
+DELIVERY_RETENTION_DAYS = 30  # days of per-group delivery log kept
+STATS_HOURLY_RETENTION_DAYS = 14  # hourly statistics kept before deletion
+STATS_DAILY_RETENTION_DAYS = 365  # daily statistics kept before folding into months
+MAINTENANCE_INTERVAL = 3600  # seconds between database cleanups
+
+# SQLite pragmas applied to every account database connection
+DB_PRAGMA_PROFILE = 'wal'
+DB_PRAGMA_PROFILES = {
+    'default': {},
+    'wal': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,  # milliseconds
+        'cache_size': -8192,  # negative = KiB
+        'temp_store': 'MEMORY',
+        'mmap_size': 64 * 1024 * 1024,  # bytes
+    },
+}
 
 # Session settings
 SESSION_DIR_NAME = 'sessions'
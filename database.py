@@ -1,112 +1,575 @@
 """
 Database management for the Telegram bot
 """
+import asyncio
+import functools
 import sqlite3
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import time
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional, List, Tuple
+from typing import Callable, Dict, Optional, List, Set, Tuple, Union
 import random
+from group_links import canonical_link
+import config
 
 logger = logging.getLogger(__name__)
 
+# Schema migrations, keyed by the PRAGMA user_version they upgrade to
+MIGRATIONS: Dict[int, Callable[[sqlite3.Cursor], None]] = {}
+
+# Python types of the known settings; other settings are kept as strings
+SETTING_TYPES = {
+    'min_interval': int,
+    'max_interval': int,
+    'auto_send': bool,
+    'send_delay': int,
+}
+
+# Pragmas reported by Database.get_pragma_report()
+REPORTED_PRAGMAS = ('journal_mode', 'synchronous', 'busy_timeout',
+                    'cache_size', 'temp_store', 'mmap_size')
+
+# Symbolic pragma values as SQLite reports them back
+_PRAGMA_VALUE_CODES = {
+    'synchronous': {'OFF': 0, 'NORMAL': 1, 'FULL': 2, 'EXTRA': 3},
+    'temp_store': {'DEFAULT': 0, 'FILE': 1, 'MEMORY': 2},
+}
+
+# Database files whose schema was already checked by this process
+_checked_schemas: Set[str] = set()
+_schema_lock = threading.Lock()
+
+
+def migration(version: int):
+    """Register a schema migration for the given version"""
+    def decorator(func):
+        if version in MIGRATIONS:
+            raise ValueError(f"Duplicate migration for schema version {version}")
+        MIGRATIONS[version] = func
+        return func
+    return decorator
+
+
+@migration(1)
+def _create_initial_schema(cursor: sqlite3.Cursor):
+    """Create the base tables and default settings"""
+    # User account table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_account (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            phone TEXT UNIQUE NOT NULL,
+            session_file TEXT NOT NULL,
+            is_active BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_login TIMESTAMP
+        )
+    ''')
+    
+    # Groups table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS groups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_link TEXT UNIQUE NOT NULL,
+            group_title TEXT,
+            group_id_telegram INTEGER,
+            members_count INTEGER DEFAULT 0,
+            is_active BOOLEAN DEFAULT 1,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_message_sent TIMESTAMP
+        )
+    ''')
+    
+    # Messages table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_text TEXT NOT NULL,
+            min_minutes INTEGER DEFAULT 60,
+            max_minutes INTEGER DEFAULT 90,
+            is_active BOOLEAN DEFAULT 1,
+            total_sent INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_sent TIMESTAMP,
+            next_send TIMESTAMP
+        )
+    ''')
+    
+    # Statistics table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS statistics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date DATE DEFAULT (date('now')),
+            messages_sent INTEGER DEFAULT 0,
+            successful_sends INTEGER DEFAULT 0,
+            failed_sends INTEGER DEFAULT 0,
+            UNIQUE(date)
+        )
+    ''')
+    
+    # Settings table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            description TEXT
+        )
+    ''')
+    
+    # Default settings
+    default_settings = [
+        ('min_interval', '60', 'Minimum interval between messages (minutes)'),
+        ('max_interval', '90', 'Maximum interval between messages (minutes)'),
+        ('auto_send', '1', 'Auto-send enabled (1/0)'),
+        ('send_delay', '2', 'Delay between sending to groups (seconds)')
+    ]
+    
+    for key, value, desc in default_settings:
+        cursor.execute('''
+            INSERT OR IGNORE INTO settings (key, value, description)
+            VALUES (?, ?, ?)
+        ''', (key, value, desc))
+
+
+@migration(2)
+def _add_scheduler_indexes(cursor: sqlite3.Cursor):
+    """Index the columns filtered by the scheduler queries"""
+    # get_pending_messages: is_active = 1 AND next_send <= now
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_pending
+        ON messages (next_send) WHERE is_active = 1
+    ''')
+
+
+@migration(3)
+def _convert_send_times_to_epoch(cursor: sqlite3.Cursor):
+    """Store messages.next_send and last_sent as integer Unix seconds"""
+    # next_send was bound from a naive local datetime, so convert from local time;
+    # last_sent came from datetime('now') and is already UTC
+    cursor.execute('''
+        UPDATE messages
+        SET next_send = COALESCE(
+            CAST(strftime('%s', next_send, 'utc') AS INTEGER),
+            CAST(strftime('%s', 'now') AS INTEGER)
+        )
+        WHERE typeof(next_send) = 'text'
+    ''')
+    cursor.execute('''
+        UPDATE messages
+        SET last_sent = CAST(strftime('%s', last_sent) AS INTEGER)
+        WHERE typeof(last_sent) = 'text'
+    ''')
+    cursor.execute('REINDEX idx_messages_pending')
+
+
+@migration(4)
+def _create_deliveries(cursor: sqlite3.Cursor):
+    """Log the outcome of every send to every group"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS deliveries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER NOT NULL,
+            group_id INTEGER NOT NULL,
+            sent_at INTEGER NOT NULL,
+            latency_ms INTEGER,
+            error_code TEXT
+        )
+    ''')
+    
+    # Retention pruning
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_deliveries_sent_at
+        ON deliveries (sent_at)
+    ''')
+    
+    # Recent failures by group
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_deliveries_failures
+        ON deliveries (group_id, sent_at) WHERE error_code IS NOT NULL
+    ''')
+
+
+@migration(5)
+def _create_stats_summary(cursor: sqlite3.Cursor):
+    """Maintain the totals shown in the account menu incrementally"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_summary (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_sent INTEGER NOT NULL DEFAULT 0,
+            active_groups INTEGER NOT NULL DEFAULT 0,
+            active_messages INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO stats_summary (id, total_sent, active_groups, active_messages)
+        VALUES (
+            1,
+            (SELECT COALESCE(SUM(total_sent), 0) FROM messages),
+            (SELECT COUNT(*) FROM groups WHERE is_active = 1),
+            (SELECT COUNT(*) FROM messages WHERE is_active = 1)
+        )
+    ''')
+    
+    # Messages: sent counter and active count
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_summary_insert
+        AFTER INSERT ON messages
+        BEGIN
+            UPDATE stats_summary
+            SET total_sent = total_sent + IFNULL(NEW.total_sent, 0),
+                active_messages = active_messages + (NEW.is_active IS 1)
+            WHERE id = 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_summary_update
+        AFTER UPDATE OF total_sent, is_active ON messages
+        BEGIN
+            UPDATE stats_summary
+            SET total_sent = total_sent + IFNULL(NEW.total_sent, 0) - IFNULL(OLD.total_sent, 0),
+                active_messages = active_messages + (NEW.is_active IS 1) - (OLD.is_active IS 1)
+            WHERE id = 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_summary_delete
+        AFTER DELETE ON messages
+        BEGIN
+            UPDATE stats_summary
+            SET total_sent = total_sent - IFNULL(OLD.total_sent, 0),
+                active_messages = active_messages - (OLD.is_active IS 1)
+            WHERE id = 1;
+        END
+    ''')
+    
+    # Groups: active count
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_groups_summary_insert
+        AFTER INSERT ON groups
+        BEGIN
+            UPDATE stats_summary
+            SET active_groups = active_groups + (NEW.is_active IS 1)
+            WHERE id = 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_groups_summary_update
+        AFTER UPDATE OF is_active ON groups
+        BEGIN
+            UPDATE stats_summary
+            SET active_groups = active_groups + (NEW.is_active IS 1) - (OLD.is_active IS 1)
+            WHERE id = 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_groups_summary_delete
+        AFTER DELETE ON groups
+        BEGIN
+            UPDATE stats_summary
+            SET active_groups = active_groups - (OLD.is_active IS 1)
+            WHERE id = 1;
+        END
+    ''')
+
+
+@migration(6)
+def _create_stats_rollups(cursor: sqlite3.Cursor):
+    """Add hourly and monthly statistics next to the daily statistics table"""
+    # hour = Unix seconds at the start of the hour
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_hourly (
+            hour INTEGER PRIMARY KEY,
+            messages_sent INTEGER DEFAULT 0,
+            successful_sends INTEGER DEFAULT 0,
+            failed_sends INTEGER DEFAULT 0
+        )
+    ''')
+    
+    # month = 'YYYY-MM', filled by compacting old daily rows
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_monthly (
+            month TEXT PRIMARY KEY,
+            messages_sent INTEGER DEFAULT 0,
+            successful_sends INTEGER DEFAULT 0,
+            failed_sends INTEGER DEFAULT 0
+        )
+    ''')
+
+
+@migration(7)
+def _add_group_peers(cursor: sqlite3.Cursor):
+    """Store what is needed to address a group without resolving it"""
+    # peer_type is 'channel' (needs access_hash) or 'chat'; NULL for groups
+    # added before this migration, which are still sent to by raw id
+    cursor.execute('ALTER TABLE groups ADD COLUMN access_hash INTEGER')
+    cursor.execute('ALTER TABLE groups ADD COLUMN peer_type TEXT')
+
+
+def _merge_groups(cursor: sqlite3.Cursor, keep: tuple, duplicates: List[tuple]):
+    """Fold duplicate groups rows into keep, moving their deliveries over"""
+    # Rows are (id, group_id_telegram, is_active, access_hash, peer_type)
+    keep_id = keep[0]
+    duplicate_ids = [row[0] for row in duplicates]
+    placeholders = ','.join('?' * len(duplicate_ids))
+    rows = [keep] + duplicates
+    cursor.execute(f'''
+        UPDATE deliveries SET group_id = ? WHERE group_id IN ({placeholders})
+    ''', [keep_id] + duplicate_ids)
+    cursor.execute(f'''
+        UPDATE groups SET
+            group_id_telegram = ?,
+            is_active = ?,
+            access_hash = ?,
+            peer_type = ?,
+            members_count = (SELECT MAX(members_count) FROM groups WHERE id IN (?, {placeholders})),
+            last_message_sent = (SELECT MAX(last_message_sent) FROM groups
+                                 WHERE id IN (?, {placeholders}))
+        WHERE id = ?
+    ''', [
+        next((row[1] for row in rows if row[1] is not None), None),
+        int(any(row[2] for row in rows)),
+        next((row[3] for row in rows if row[3] is not None), None),
+        next((row[4] for row in rows if row[4] is not None), None),
+        keep_id, *duplicate_ids, keep_id, *duplicate_ids, keep_id
+    ])
+    cursor.execute(f'DELETE FROM groups WHERE id IN ({placeholders})', duplicate_ids)
+
+
+@migration(8)
+def _dedupe_groups(cursor: sqlite3.Cursor):
+    """Merge groups added under different spellings and keep them unique"""
+    # Duplicates are the same chat (group_id_telegram) or the same canonical
+    # link; the oldest row survives
+    for key in (lambda row: row[1], lambda row: canonical_link(row[5])):
+        cursor.execute('''
+            SELECT id, group_id_telegram, is_active, access_hash, peer_type, group_link
+            FROM groups ORDER BY id
+        ''')
+        by_key: Dict[object, List[tuple]] = {}
+        for row in cursor.fetchall():
+            if key(row) is not None:
+                by_key.setdefault(key(row), []).append(row[:5])
+        for rows in by_key.values():
+            if len(rows) > 1:
+                _merge_groups(cursor, rows[0], rows[1:])
+    
+    cursor.execute('SELECT id, group_link FROM groups')
+    cursor.executemany('UPDATE groups SET group_link = ? WHERE id = ?', [
+        (canonical_link(group_link), group_id)
+        for group_id, group_link in cursor.fetchall()
+    ])
+    
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_groups_telegram_id
+        ON groups (group_id_telegram)
+    ''')
+
+
+@migration(9)
+def _add_group_fail_streak(cursor: sqlite3.Cursor):
+    """Count consecutive permanent send failures per group"""
+    cursor.execute('ALTER TABLE groups ADD COLUMN fail_streak INTEGER NOT NULL DEFAULT 0')
+
+
+@migration(10)
+def _drop_groups_active_index(cursor: sqlite3.Cursor):
+    """Drop the partial groups(id) index, which barely helps SELECT * and slows writes"""
+    cursor.execute('DROP INDEX IF EXISTS idx_groups_active')
+
+
+def apply_migrations(conn: sqlite3.Connection, target_version: Optional[int] = None) -> int:
+    """Apply pending migrations up to target_version and return the resulting version"""
+    if target_version is None:
+        target_version = max(MIGRATIONS)
+    
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for next_version in sorted(v for v in MIGRATIONS if version < v <= target_version):
+        try:
+            # IMMEDIATE takes the write lock up front so two processes cannot
+            # run the same migration; re-read the version once we hold it
+            conn.execute('BEGIN IMMEDIATE')
+            current = conn.execute('PRAGMA user_version').fetchone()[0]
+            if current >= next_version:
+                conn.rollback()
+                version = current
+                continue
+            MIGRATIONS[next_version](conn.cursor())
+            conn.execute(f'PRAGMA user_version = {int(next_version)}')
+            conn.commit()
+            version = next_version
+            logger.info(f"Applied schema migration {next_version}")
+        except Exception:
+            conn.rollback()
+            raise
+    return version
+
+
+def schedule_next_send(min_minutes: int, max_minutes: int) -> int:
+    """Pick a random next send time (Unix seconds) within the interval"""
+    return int(time.time()) + random.randint(min_minutes, max_minutes) * 60
+
+
+def parse_setting(key: str, value: str):
+    """Convert a stored setting string to its SETTING_TYPES type"""
+    setting_type = SETTING_TYPES.get(key, str)
+    if setting_type is bool:
+        return int(value) != 0
+    return setting_type(value)
+
+
+def get_pragma_profile() -> Dict[str, object]:
+    """Get the configured pragma profile"""
+    profile = config.DB_PRAGMA_PROFILES.get(config.DB_PRAGMA_PROFILE)
+    if profile is None:
+        logger.warning(f"Unknown pragma profile {config.DB_PRAGMA_PROFILE!r}, using SQLite defaults")
+        return {}
+    return profile
+
+
+def _normalize_pragma_value(name: str, value) -> str:
+    """Normalize a pragma value so configured and reported values compare equal"""
+    if isinstance(value, str):
+        value = _PRAGMA_VALUE_CODES.get(name, {}).get(value.upper(), value)
+    return str(value).lower()
+
+
+def forget_schema_check(db_path: Path):
+    """Make the next Database() for this file re-check its schema (e.g. after deletion)"""
+    with _schema_lock:
+        _checked_schemas.discard(str(db_path.resolve()))
+
 
 class Database:
     """Database handler for account data"""
     
     def __init__(self, account_path: Path):
         self.account_path = account_path
-        self.db_path = account_path / 'bot.db'
+        self.db_path = account_path / config.DB_NAME
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._settings_cache: Optional[Tuple[Dict[str, str], Dict[str, object]]] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._maintained_at = float('-inf')
+        self._aio: Optional['AsyncDatabase'] = None
+        self._closed = False
+        self._connections_closed = False
         self.init_database()
     
-    def get_connection(self):
-        """Get database connection"""
-        return sqlite3.connect(self.db_path)
+    def __enter__(self):
+        return self
     
-    def init_database(self):
-        """Initialize database tables"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # User account table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_account (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                phone TEXT UNIQUE NOT NULL,
-                session_file TEXT NOT NULL,
-                is_active BOOLEAN DEFAULT 1,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_login TIMESTAMP
-            )
-        ''')
-        
-        # Groups table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS groups (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                group_link TEXT UNIQUE NOT NULL,
-                group_title TEXT,
-                group_id_telegram INTEGER,
-                members_count INTEGER DEFAULT 0,
-                is_active BOOLEAN DEFAULT 1,
-                added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_message_sent TIMESTAMP
-            )
-        ''')
-        
-        # Messages table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                message_text TEXT NOT NULL,
-                min_minutes INTEGER DEFAULT 60,
-                max_minutes INTEGER DEFAULT 90,
-                is_active BOOLEAN DEFAULT 1,
-                total_sent INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_sent TIMESTAMP,
-                next_send TIMESTAMP
-            )
-        ''')
-        
-        # Statistics table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS statistics (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                date DATE DEFAULT (date('now')),
-                messages_sent INTEGER DEFAULT 0,
-                successful_sends INTEGER DEFAULT 0,
-                failed_sends INTEGER DEFAULT 0,
-                UNIQUE(date)
-            )
-        ''')
-        
-        # Settings table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT NOT NULL,
-                description TEXT
-            )
-        ''')
-        
-        # Default settings
-        default_settings = [
-            ('min_interval', '60', 'Minimum interval between messages (minutes)'),
-            ('max_interval', '90', 'Maximum interval between messages (minutes)'),
-            ('auto_send', '1', 'Auto-send enabled (1/0)'),
-            ('send_delay', '2', 'Delay between sending to groups (seconds)')
-        ]
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def get_connection(self) -> sqlite3.Connection:
+        """Get the calling thread's database connection, opening it on first use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self._connections_closed:
+                raise sqlite3.ProgrammingError(f"Database {self.db_path} is closed")
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            for name, value in get_pragma_profile().items():
+                conn.execute(f'PRAGMA {name} = {value}')
+            with self._lock:
+                if self._connections_closed:
+                    # The connections were closed while this one was being opened
+                    conn.close()
+                    raise sqlite3.ProgrammingError(f"Database {self.db_path} is closed")
+                self._connections.append(conn)
+            self._local.conn = conn
+        return conn
+    
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """Single worker thread that runs this database's calls for AsyncDatabase"""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f"Database {self.db_path} is closed")
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix=f"db-{self.account_path.name}"
+                )
+            return self._executor
+    
+    @property
+    def aio(self) -> 'AsyncDatabase':
+        """Awaitable view of this database"""
+        if self._aio is None:
+            self._aio = AsyncDatabase(self)
+        return self._aio
+    
+    def close(self, wait: bool = True):
+        """Close all pooled connections for good
         
-        for key, value, desc in default_settings:
-            cursor.execute('''
-                INSERT OR IGNORE INTO settings (key, value, description)
-                VALUES (?, ?, ?)
-            ''', (key, value, desc))
+        A closed Database refuses new executor work, so a stale reference
+        can't reopen threads or connections nobody closes; get a fresh
+        instance from the AccountManager instead.
+        Work already queued on the executor still runs, opening a connection
+        if it needs one; the connections are closed on the executor's thread
+        after it, so with wait=False the caller (e.g. the event loop evicting
+        a cached database) never waits for writes.
+        """
+        with self._lock:
+            self._closed = True
+            executor = self._executor
+            self._executor = None
         
-        conn.commit()
-        conn.close()
-        logger.info(f"Database initialized at {self.db_path}")
+        if executor is None:
+            self._close_connections()
+            return
+        # Queued behind any pending calls, so those still get a connection
+        executor.submit(self._close_connections)
+        executor.shutdown(wait=wait)
+    
+    def _close_connections(self):
+        """Close every pooled connection and refuse to open new ones"""
+        with self._lock:
+            self._connections_closed = True
+            connections = self._connections
+            self._connections = []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.error(f"Error closing connection: {e}")
+    
+    def _rollback(self):
+        """Roll back a transaction left open by a failed write"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and conn.in_transaction:
+            try:
+                conn.rollback()
+            except Exception as e:
+                logger.error(f"Error rolling back: {e}")
+    
+    def init_database(self):
+        """Bring the schema up to date, once per process per database file"""
+        key = str(self.db_path.resolve())
+        with _schema_lock:
+            if key in _checked_schemas:
+                return
+            version = apply_migrations(self.get_connection())
+            _checked_schemas.add(key)
+        logger.info(f"Database initialized at {self.db_path} (schema v{version})")
+    
+    def get_pragma_report(self) -> Dict[str, dict]:
+        """Get the effective value of each reported pragma next to the configured one"""
+        conn = self.get_connection()
+        profile = get_pragma_profile()
+        report = {}
+        for name in REPORTED_PRAGMAS:
+            actual = conn.execute(f'PRAGMA {name}').fetchone()[0]
+            expected = profile.get(name)
+            report[name] = {
+                'actual': actual,
+                'expected': expected,
+                'ok': expected is None or
+                      _normalize_pragma_value(name, actual) == _normalize_pragma_value(name, expected)
+            }
+        return report
     
     # User methods
     def save_user(self, phone: str, session_file: str) -> bool:
@@ -119,9 +582,9 @@ class Database:
                 VALUES (?, ?, CURRENT_TIMESTAMP)
             ''', (phone, session_file))
             conn.commit()
-            conn.close()
             return True
         except Exception as e:
+            self._rollback()
             logger.error(f"Error saving user: {e}")
             return False
     
@@ -132,7 +595,6 @@ class Database:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM user_account WHERE is_active = 1 LIMIT 1')
             result = cursor.fetchone()
-            conn.close()
             return result
         except Exception as e:
             logger.error(f"Error getting user: {e}")
@@ -145,26 +607,71 @@ class Database:
     # Group methods
     def add_group(self, group_link: str, group_title: str, 
                   group_id_telegram: Optional[int] = None, 
-                  members_count: int = 0) -> bool:
-        """Add a group"""
+                  members_count: int = 0,
+                  access_hash: Optional[int] = None,
+                  peer_type: Optional[str] = None) -> bool:
+        """Add a group under its canonical link"""
+        group_link = canonical_link(group_link)
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO groups (group_link, group_title, group_id_telegram, members_count)
-                VALUES (?, ?, ?, ?)
-            ''', (group_link, group_title, group_id_telegram, members_count))
+                INSERT INTO groups (group_link, group_title, group_id_telegram, members_count,
+                                    access_hash, peer_type)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (group_link, group_title, group_id_telegram, members_count,
+                  access_hash, peer_type))
             conn.commit()
-            conn.close()
             logger.info(f"Added group: {group_title}")
             return True
         except sqlite3.IntegrityError:
+            self._rollback()
             logger.warning(f"Group already exists: {group_link}")
             return False
         except Exception as e:
+            self._rollback()
             logger.error(f"Error adding group: {e}")
             return False
     
+    def find_group(self, group_link: str) -> Optional[Tuple]:
+        """Get the group stored under any spelling of a link"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM groups WHERE group_link = ?',
+                           (canonical_link(group_link),))
+            return cursor.fetchone()
+        except Exception as e:
+            logger.error(f"Error finding group: {e}")
+            return None
+    
+    def find_group_by_telegram_id(self, group_id_telegram: int) -> Optional[Tuple]:
+        """Get the group stored for a Telegram chat id"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM groups WHERE group_id_telegram = ?',
+                           (group_id_telegram,))
+            return cursor.fetchone()
+        except Exception as e:
+            logger.error(f"Error finding group: {e}")
+            return None
+    
+    def update_group_peer(self, group_id: int, access_hash: Optional[int],
+                          peer_type: str) -> bool:
+        """Store the peer a group is sent to, for rows added without one"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute('UPDATE groups SET access_hash = ?, peer_type = ? WHERE id = ?',
+                           (access_hash, peer_type, group_id))
+            conn.commit()
+            return True
+        except Exception as e:
+            self._rollback()
+            logger.error(f"Error updating group peer: {e}")
+            return False
+    
     def get_groups(self, active_only: bool = True) -> List[Tuple]:
         """Get all groups"""
         try:
@@ -175,7 +682,6 @@ class Database:
             else:
                 cursor.execute('SELECT * FROM groups')
             results = cursor.fetchall()
-            conn.close()
             return results
         except Exception as e:
             logger.error(f"Error getting groups: {e}")
@@ -186,13 +692,17 @@ class Database:
         try:
             conn = self.get_connection()
             cursor = conn.cursor()
+            # Re-enabling a group gives it a fresh failure streak
             cursor.execute('''
-                UPDATE groups SET is_active = ? WHERE id = ?
-            ''', (int(is_active), group_id))
+                UPDATE groups
+                SET is_active = ?,
+                    fail_streak = CASE WHEN ? THEN 0 ELSE fail_streak END
+                WHERE id = ?
+            ''', (int(is_active), int(is_active), group_id))
             conn.commit()
-            conn.close()
             return True
         except Exception as e:
+            self._rollback()
             logger.error(f"Error updating group status: {e}")
             return False
     
@@ -203,9 +713,9 @@ class Database:
             cursor = conn.cursor()
             cursor.execute('DELETE FROM groups WHERE id = ?', (group_id,))
             conn.commit()
-            conn.close()
             return True
         except Exception as e:
+            self._rollback()
             logger.error(f"Error deleting group: {e}")
             return False
     
@@ -214,9 +724,7 @@ class Database:
                    max_minutes: int = 90) -> bool:
         """Add a message"""
         try:
-            next_send = datetime.now() + timedelta(
-                minutes=random.randint(min_minutes, max_minutes)
-            )
+            next_send = schedule_next_send(min_minutes, max_minutes)
             conn = self.get_connection()
             cursor = conn.cursor()
             cursor.execute('''
@@ -224,10 +732,10 @@ class Database:
                 VALUES (?, ?, ?, ?)
             ''', (message_text, min_minutes, max_minutes, next_send))
             conn.commit()
-            conn.close()
-            logger.info(f"Added message, next send at {next_send}")
+            logger.info(f"Added message, next send at {datetime.fromtimestamp(next_send)}")
             return True
         except Exception as e:
+            self._rollback()
             logger.error(f"Error adding message: {e}")
             return False
     
@@ -241,7 +749,6 @@ class Database:
             else:
                 cursor.execute('SELECT * FROM messages')
             results = cursor.fetchall()
-            conn.close()
             return results
         except Exception as e:
             logger.error(f"Error getting messages: {e}")
@@ -254,39 +761,33 @@ class Database:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT * FROM messages 
-                WHERE is_active = 1 AND next_send <= datetime('now')
-            ''')
+                WHERE is_active = 1 AND next_send <= ?
+            ''', (int(time.time()),))
             results = cursor.fetchall()
-            conn.close()
             return results
         except Exception as e:
             logger.error(f"Error getting pending messages: {e}")
             return []
     
-    def update_message_after_send(self, message_id: int) -> bool:
-        """Update message after sending"""
+    def get_message_schedule(self) -> Optional[List[Tuple[int, int]]]:
+        """Get (message_id, next_send) for every active message, or None on error"""
         try:
-            min_minutes = int(self.get_setting('min_interval', '60'))
-            max_minutes = int(self.get_setting('max_interval', '90'))
-            next_send = datetime.now() + timedelta(
-                minutes=random.randint(min_minutes, max_minutes)
-            )
-            
             conn = self.get_connection()
             cursor = conn.cursor()
             cursor.execute('''
-                UPDATE messages 
-                SET total_sent = total_sent + 1,
-                    last_sent = datetime('now'),
-                    next_send = ?
-                WHERE id = ?
-            ''', (next_send, message_id))
-            conn.commit()
-            conn.close()
-            return True
+                SELECT id, next_send FROM messages
+                WHERE is_active = 1 AND next_send IS NOT NULL
+            ''')
+            return cursor.fetchall()
         except Exception as e:
-            logger.error(f"Error updating message: {e}")
-            return False
+            logger.error(f"Error getting message schedule: {e}")
+            return None
+    
+    def update_message_after_send(self, message_id: int) -> bool:
+        """Update message after sending"""
+        batch = SendBatch()
+        batch.message_sent(message_id)
+        return self.flush_batch(batch)
     
     def delete_message(self, message_id: int) -> bool:
         """Delete a message"""
@@ -295,26 +796,44 @@ class Database:
             cursor = conn.cursor()
             cursor.execute('DELETE FROM messages WHERE id = ?', (message_id,))
             conn.commit()
-            conn.close()
             return True
         except Exception as e:
+            self._rollback()
             logger.error(f"Error deleting message: {e}")
             return False
     
     # Settings methods
+    def _load_settings(self) -> Tuple[Dict[str, str], Dict[str, object]]:
+        """Get (raw, typed) settings, reading the table once until invalidated"""
+        cache = self._settings_cache
+        if cache is None:
+            conn = self.get_connection()
+            raw = dict(conn.execute('SELECT key, value FROM settings').fetchall())
+            typed = {}
+            for key, value in raw.items():
+                try:
+                    typed[key] = parse_setting(key, value)
+                except ValueError:
+                    logger.warning(f"Invalid value for setting {key}: {value!r}")
+            cache = self._settings_cache = (raw, typed)
+        return cache
+    
     def get_setting(self, key: str, default: str = None) -> Optional[str]:
         """Get a setting value"""
         try:
-            conn = self.get_connection()
-            cursor = conn.cursor()
-            cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
-            result = cursor.fetchone()
-            conn.close()
-            return result[0] if result else default
+            return self._load_settings()[0].get(key, default)
         except Exception as e:
             logger.error(f"Error getting setting: {e}")
             return default
     
+    def get_settings(self) -> Dict[str, object]:
+        """Get all settings converted to their SETTING_TYPES type"""
+        try:
+            return dict(self._load_settings()[1])
+        except Exception as e:
+            logger.error(f"Error getting settings: {e}")
+            return {}
+    
     def set_setting(self, key: str, value: str) -> bool:
         """Set a setting value"""
         try:
@@ -325,11 +844,13 @@ class Database:
                 VALUES (?, ?)
             ''', (key, value))
             conn.commit()
-            conn.close()
             return True
         except Exception as e:
+            self._rollback()
             logger.error(f"Error setting value: {e}")
             return False
+        finally:
+            self._settings_cache = None
     
     def get_all_settings(self) -> List[Tuple]:
         """Get all settings"""
@@ -338,7 +859,6 @@ class Database:
             cursor = conn.cursor()
             cursor.execute('SELECT key, value, description FROM settings')
             results = cursor.fetchall()
-            conn.close()
             return results
         except Exception as e:
             logger.error(f"Error getting settings: {e}")
@@ -347,26 +867,162 @@ class Database:
     # Statistics methods
     def update_stats(self, messages_sent: int, successful: int, failed: int) -> bool:
         """Update statistics"""
+        batch = SendBatch()
+        batch.add_stats(messages_sent, successful, failed)
+        return self.flush_batch(batch)
+    
+    # Batch methods
+    def flush_batch(self, batch: 'SendBatch') -> bool:
+        """Write everything recorded in a send round in a single transaction
+        
+        Groups disabled for repeated permanent failures are left in
+        batch.deactivated_groups as (group_id, group_title, last_error).
+        """
+        if batch.is_empty():
+            return True
+        
         try:
-            today = datetime.now().date().isoformat()
+            now = int(time.time())
             conn = self.get_connection()
             cursor = conn.cursor()
             
-            cursor.execute('''
-                INSERT INTO statistics (date, messages_sent, successful_sends, failed_sends)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(date) DO UPDATE SET
-                    messages_sent = messages_sent + excluded.messages_sent,
-                    successful_sends = successful_sends + excluded.successful_sends,
-                    failed_sends = failed_sends + excluded.failed_sends
-            ''', (today, messages_sent, successful, failed))
+            if batch.sent_messages:
+                settings = self.get_settings()
+                min_minutes = settings.get('min_interval', 60)
+                max_minutes = settings.get('max_interval', 90)
+                cursor.executemany('''
+                    UPDATE messages 
+                    SET total_sent = total_sent + 1,
+                        last_sent = ?,
+                        next_send = ?
+                    WHERE id = ?
+                ''', [
+                    (now, schedule_next_send(min_minutes, max_minutes), message_id)
+                    for message_id in batch.sent_messages
+                ])
+            
+            if batch.messages_sent:
+                today = datetime.now().date().isoformat()
+                counts = (batch.messages_sent, batch.successful, batch.failed)
+                cursor.execute('''
+                    INSERT INTO statistics (date, messages_sent, successful_sends, failed_sends)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(date) DO UPDATE SET
+                        messages_sent = messages_sent + excluded.messages_sent,
+                        successful_sends = successful_sends + excluded.successful_sends,
+                        failed_sends = failed_sends + excluded.failed_sends
+                ''', (today, *counts))
+                cursor.execute('''
+                    INSERT INTO stats_hourly (hour, messages_sent, successful_sends, failed_sends)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(hour) DO UPDATE SET
+                        messages_sent = messages_sent + excluded.messages_sent,
+                        successful_sends = successful_sends + excluded.successful_sends,
+                        failed_sends = failed_sends + excluded.failed_sends
+                ''', (now - now % 3600, *counts))
+            
+            if batch.deliveries:
+                cursor.executemany('''
+                    INSERT INTO deliveries (message_id, group_id, sent_at, latency_ms, error_code)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', batch.deliveries)
+                
+                last_sent = {}
+                for _, group_id, sent_at, _, error_code in batch.deliveries:
+                    if error_code is None:
+                        last_sent[group_id] = max(sent_at, last_sent.get(group_id, 0))
+                cursor.executemany(
+                    'UPDATE groups SET last_message_sent = ? WHERE id = ?',
+                    [(sent_at, group_id) for group_id, sent_at in last_sent.items()]
+                )
+            
+            deactivated = []
+            if batch.reset_groups:
+                cursor.executemany(
+                    'UPDATE groups SET fail_streak = 0 WHERE id = ?',
+                    [(group_id,) for group_id in batch.reset_groups]
+                )
+            if batch.permanent_failures:
+                cursor.executemany(
+                    'UPDATE groups SET fail_streak = fail_streak + ? WHERE id = ?',
+                    [(count, group_id) for group_id, count in batch.permanent_failures.items()]
+                )
+                if config.GROUP_MAX_PERMANENT_FAILURES > 0:
+                    group_ids = list(batch.permanent_failures)
+                    cursor.execute(f'''
+                        SELECT id, group_title FROM groups
+                        WHERE id IN ({','.join('?' * len(group_ids))})
+                            AND is_active = 1 AND fail_streak >= ?
+                    ''', (*group_ids, config.GROUP_MAX_PERMANENT_FAILURES))
+                    deactivated = [
+                        (group_id, title, batch.last_errors[group_id])
+                        for group_id, title in cursor.fetchall()
+                    ]
+                    cursor.executemany(
+                        'UPDATE groups SET is_active = 0 WHERE id = ?',
+                        [(group_id,) for group_id, _, _ in deactivated]
+                    )
             
             conn.commit()
-            conn.close()
-            return True
+            batch.deactivated_groups = deactivated
+            for group_id, title, last_error in deactivated:
+                logger.warning(f"Disabled group {title or group_id} after repeated {last_error}")
         except Exception as e:
-            logger.error(f"Error updating stats: {e}")
+            self._rollback()
+            logger.error(f"Error flushing send batch: {e}")
             return False
+        
+        self.run_maintenance()
+        return True
+    
+    # Delivery log methods
+    def get_recent_failures(self, hours: int = 24) -> List[Tuple]:
+        """Get (group_id, group_title, failures, last_error) for groups that failed recently"""
+        try:
+            since = int(time.time()) - hours * 3600
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT d.group_id, g.group_title, COUNT(*) AS failures,
+                       (SELECT error_code FROM deliveries
+                        WHERE group_id = d.group_id AND error_code IS NOT NULL
+                        ORDER BY sent_at DESC LIMIT 1) AS last_error
+                FROM deliveries d
+                LEFT JOIN groups g ON g.id = d.group_id
+                WHERE d.error_code IS NOT NULL AND d.sent_at >= ?
+                GROUP BY d.group_id
+                ORDER BY failures DESC
+            ''', (since,))
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Error getting recent failures: {e}")
+            return []
+    
+    def prune_deliveries(self, retention_days: int = config.DELIVERY_RETENTION_DAYS) -> int:
+        """Delete delivery log rows older than the retention period"""
+        try:
+            cutoff = int(time.time()) - retention_days * 86400
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM deliveries WHERE sent_at < ?', (cutoff,))
+            conn.commit()
+            return cursor.rowcount
+        except Exception as e:
+            self._rollback()
+            logger.error(f"Error pruning deliveries: {e}")
+            return 0
+    
+    def run_maintenance(self, force: bool = False):
+        """Run periodic cleanup at most once per MAINTENANCE_INTERVAL"""
+        now = time.monotonic()
+        if not force and now - self._maintained_at < config.MAINTENANCE_INTERVAL:
+            return
+        self._maintained_at = now
+        
+        pruned = self.prune_deliveries()
+        if pruned:
+            logger.info(f"Pruned {pruned} old deliveries from {self.db_path}")
+        self.compact_stats()
     
     def get_today_stats(self) -> dict:
         """Get today's statistics"""
@@ -379,7 +1035,6 @@ class Database:
                 FROM statistics WHERE date = ?
             ''', (today,))
             result = cursor.fetchone()
-            conn.close()
             
             if result:
                 return {
@@ -392,35 +1047,117 @@ class Database:
             logger.error(f"Error getting today stats: {e}")
             return {'messages_sent': 0, 'successful': 0, 'failed': 0}
     
+    def get_hourly_stats(self, hours: int = 24) -> List[Tuple[int, int, int, int]]:
+        """Get (hour start, sent, successful, failed) for the last hours"""
+        try:
+            now = int(time.time())
+            since = now - now % 3600 - (hours - 1) * 3600
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT hour, messages_sent, successful_sends, failed_sends
+                FROM stats_hourly WHERE hour >= ? ORDER BY hour
+            ''', (since,))
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Error getting hourly stats: {e}")
+            return []
+    
+    def get_daily_stats(self, days: int = 7) -> List[Tuple[str, int, int, int]]:
+        """Get (date, sent, successful, failed) for the last days"""
+        try:
+            since = (datetime.now().date() - timedelta(days=days - 1)).isoformat()
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT date, messages_sent, successful_sends, failed_sends
+                FROM statistics WHERE date >= ? ORDER BY date
+            ''', (since,))
+            return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Error getting daily stats: {e}")
+            return []
+    
+    def get_monthly_stats(self, months: int = 12) -> List[Tuple[str, int, int, int]]:
+        """Get (YYYY-MM, sent, successful, failed) for the last months"""
+        try:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            # Recent months still live in the daily table
+            cursor.execute('''
+                SELECT month, SUM(messages_sent), SUM(successful_sends), SUM(failed_sends)
+                FROM (
+                    SELECT month, messages_sent, successful_sends, failed_sends
+                    FROM stats_monthly
+                    UNION ALL
+                    SELECT substr(date, 1, 7), messages_sent, successful_sends, failed_sends
+                    FROM statistics
+                )
+                GROUP BY month ORDER BY month DESC LIMIT ?
+            ''', (months,))
+            return cursor.fetchall()[::-1]
+        except Exception as e:
+            logger.error(f"Error getting monthly stats: {e}")
+            return []
+    
+    def compact_stats(self):
+        """Drop expired hourly rows and fold old daily rows into monthly ones
+        
+        Daily rows are written alongside hourly ones, so expired hourly
+        buckets are already accounted for and can simply be deleted.
+        """
+        try:
+            now = int(time.time())
+            hourly_cutoff = now - config.STATS_HOURLY_RETENTION_DAYS * 86400
+            daily_cutoff = (
+                datetime.now().date() - timedelta(days=config.STATS_DAILY_RETENTION_DAYS)
+            ).isoformat()
+            
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM stats_hourly WHERE hour < ?', (hourly_cutoff,))
+            cursor.execute('''
+                INSERT INTO stats_monthly (month, messages_sent, successful_sends, failed_sends)
+                SELECT substr(date, 1, 7), SUM(messages_sent), SUM(successful_sends), SUM(failed_sends)
+                FROM statistics WHERE date < ?
+                GROUP BY substr(date, 1, 7)
+                ON CONFLICT(month) DO UPDATE SET
+                    messages_sent = messages_sent + excluded.messages_sent,
+                    successful_sends = successful_sends + excluded.successful_sends,
+                    failed_sends = failed_sends + excluded.failed_sends
+            ''', (daily_cutoff,))
+            cursor.execute('DELETE FROM statistics WHERE date < ?', (daily_cutoff,))
+            conn.commit()
+        except Exception as e:
+            self._rollback()
+            logger.error(f"Error compacting stats: {e}")
+    
     def get_total_stats(self) -> dict:
         """Get total statistics"""
         try:
+            today = datetime.now().date().isoformat()
             conn = self.get_connection()
             cursor = conn.cursor()
             
-            # Total messages sent
-            cursor.execute('SELECT SUM(total_sent) FROM messages')
-            total_sent = cursor.fetchone()[0] or 0
-            
-            # Total groups
-            cursor.execute('SELECT COUNT(*) FROM groups WHERE is_active = 1')
-            total_groups = cursor.fetchone()[0] or 0
-            
-            # Total messages
-            cursor.execute('SELECT COUNT(*) FROM messages WHERE is_active = 1')
-            total_messages = cursor.fetchone()[0] or 0
-            
-            conn.close()
-            
-            today_stats = self.get_today_stats()
+            # Totals are kept up to date by triggers (see migration 5)
+            cursor.execute('''
+                SELECT s.total_sent, s.active_groups, s.active_messages,
+                       COALESCE(t.messages_sent, 0),
+                       COALESCE(t.successful_sends, 0),
+                       COALESCE(t.failed_sends, 0)
+                FROM stats_summary s
+                LEFT JOIN statistics t ON t.date = ?
+                WHERE s.id = 1
+            ''', (today,))
+            result = cursor.fetchone()
             
             return {
-                'total_sent': total_sent,
-                'total_groups': total_groups,
-                'total_messages': total_messages,
-                'today_sent': today_stats['messages_sent'],
-                'today_successful': today_stats['successful'],
-                'today_failed': today_stats['failed']
+                'total_sent': result[0],
+                'total_groups': result[1],
+                'total_messages': result[2],
+                'today_sent': result[3],
+                'today_successful': result[4],
+                'today_failed': result[5]
             }
         except Exception as e:
             logger.error(f"Error getting total stats: {e}")
@@ -432,3 +1169,77 @@ class Database:
                 'today_successful': 0,
                 'today_failed': 0
           }
+
+
+class SendBatch:
+    """Bookkeeping of one send round, written by Database.flush_batch"""
+    
+    def __init__(self):
+        self.sent_messages: List[int] = []
+        self.messages_sent = 0
+        self.successful = 0
+        self.failed = 0
+        # (message_id, group_id, sent_at, latency_ms, error_code)
+        self.deliveries: List[Tuple[int, int, int, int, Optional[str]]] = []
+        # Groups that succeeded, and permanent failures since their last success
+        self.reset_groups: Set[int] = set()
+        self.permanent_failures: Dict[int, int] = {}
+        self.last_errors: Dict[int, str] = {}
+        # Filled by Database.flush_batch
+        self.deactivated_groups: List[Tuple[int, str, str]] = []
+    
+    def message_sent(self, message_id: int):
+        """Count a send and schedule the message's next one"""
+        self.sent_messages.append(message_id)
+    
+    def add_stats(self, messages_sent: int, successful: int, failed: int):
+        """Add to today's statistics"""
+        self.messages_sent += messages_sent
+        self.successful += successful
+        self.failed += failed
+    
+    def add_delivery(self, message_id: int, group_id: int, sent_at: int,
+                     latency_ms: int, error_code: Optional[str] = None,
+                     permanent: bool = False):
+        """Record the outcome of sending a message to one group
+        
+        permanent marks errors that retrying won't fix (kicked, banned, no
+        write access); they count towards disabling the group.
+        """
+        self.deliveries.append((message_id, group_id, sent_at, latency_ms, error_code))
+        if error_code is None:
+            self.reset_groups.add(group_id)
+            self.permanent_failures.pop(group_id, None)
+        elif permanent:
+            self.permanent_failures[group_id] = self.permanent_failures.get(group_id, 0) + 1
+            self.last_errors[group_id] = error_code
+    
+    def is_empty(self) -> bool:
+        """Check if there is nothing to write"""
+        return not (self.sent_messages or self.messages_sent or self.deliveries)
+
+
+class AsyncDatabase:
+    """Runs Database methods on the database's own thread so callers can await them"""
+    
+    def __init__(self, db: Union[Database, Callable[[], Database]]):
+        # Either a Database, or a function returning the current one; the
+        # latter is looked up on every call so it survives cache eviction
+        self._resolve = db if callable(db) else (lambda: db)
+    
+    @property
+    def db(self) -> Database:
+        return self._resolve()
+    
+    def __getattr__(self, name):
+        if not callable(getattr(Database, name, None)):
+            return getattr(self.db, name)
+        
+        @functools.wraps(getattr(Database, name))
+        async def call(*args, **kwargs):
+            db = self.db
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                db.executor, functools.partial(getattr(db, name), *args, **kwargs)
+            )
+        return call
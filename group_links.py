@@ -0,0 +1,68 @@
+"""
+Parsing of user-supplied Telegram group links
+"""
+import re
+from typing import NamedTuple, Optional, Union
+
+# Link kinds, each joined differently
+USERNAME = 'username'
+INVITE = 'invite'
+NUMERIC_ID = 'id'
+
+_URL_PREFIX = re.compile(r'^(?:https?://)?(?:www\.)?(?:t|telegram)\.(?:me|dog)/', re.IGNORECASE)
+_USERNAME = re.compile(r'[A-Za-z][A-Za-z0-9_]{3,31}')
+_INVITE_HASH = re.compile(r'[A-Za-z0-9_-]+')
+_NUMERIC_ID = re.compile(r'-?\d+')
+
+
+class GroupLink(NamedTuple):
+    """A group link reduced to its kind and the value used to join it"""
+    kind: str
+    value: Union[str, int]
+
+
+def parse_group_link(link: str) -> Optional[GroupLink]:
+    """Classify a link as a username, an invite hash or a numeric id
+    
+    Accepts @name, name, t.me/name, https://t.me/+hash, t.me/joinchat/hash
+    and bare ids. Returns None if the link is none of these.
+    """
+    path = _URL_PREFIX.sub('', link.strip()).split('?')[0].strip('/')
+    
+    if path.startswith('+'):
+        invite_hash = path[1:]
+    elif path.lower().startswith('joinchat/'):
+        invite_hash = path.split('/', 1)[1]
+    else:
+        invite_hash = None
+    if invite_hash is not None:
+        if _INVITE_HASH.fullmatch(invite_hash):
+            return GroupLink(INVITE, invite_hash)
+        return None
+    
+    if _NUMERIC_ID.fullmatch(path):
+        return GroupLink(NUMERIC_ID, int(path))
+    
+    # t.me/name/123 links to a post; the group is the first part
+    username = path.lstrip('@').split('/')[0]
+    if _USERNAME.fullmatch(username):
+        return GroupLink(USERNAME, username)
+    return None
+
+
+def canonical_link(link: str) -> str:
+    """Get the one spelling stored for a link, so variants of it dedupe
+    
+    Usernames become https://t.me/<lowercase name>, invites
+    https://t.me/+<hash> and ids their decimal form. Links that can't be
+    parsed are only stripped.
+    """
+    parsed = parse_group_link(link)
+    if parsed is None:
+        return link.strip()
+    if parsed.kind == USERNAME:
+        # Telegram usernames are case-insensitive; invite hashes are not
+        return f"https://t.me/{parsed.value.lower()}"
+    if parsed.kind == INVITE:
+        return f"https://t.me/+{parsed.value}"
+    return str(parsed.value)
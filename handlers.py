@@ -3,8 +3,9 @@ Command and callback handlers for the bot
 """
 import logging
 import re
+import time
+from datetime import datetime
 from telethon import Button
-from database import Database
 from session_manager import SessionManager
 import config
 
@@ -74,43 +75,42 @@ class BotHandlers:
     
     async def show_account_menu(self, event, account_id):
         """Show account management menu"""
-        account_path = self.account_manager.get_account_path(account_id)
-        db = Database(account_path)
-        user_data = db.get_user()
-        
-        if user_data:
-            phone = user_data[1]
-            stats = db.get_total_stats()
+        with self.account_manager.pinned_database(account_id) as db:
+            user_data = await db.get_user()
             
-            text = (
-                f"📱 **Account: {account_id}**\n"
-                f"📞 **Phone: {phone}**\n\n"
-                f"📊 **Statistics:**\n"
-                f"• Total Sent: {stats['total_sent']}\n"
-                f"• Groups: {stats['total_groups']}\n"
-                f"• Messages: {stats['total_messages']}\n"
-                f"• Today: {stats['today_sent']}\n\n"
-                "Select an action:"
-            )
+            if user_data:
+                phone = user_data[1]
+                stats = await db.get_total_stats()
+                
+                text = (
+                    f"📱 **Account: {account_id}**\n"
+                    f"📞 **Phone: {phone}**\n\n"
+                    f"📊 **Statistics:**\n"
+                    f"• Total Sent: {stats['total_sent']}\n"
+                    f"• Groups: {stats['total_groups']}\n"
+                    f"• Messages: {stats['total_messages']}\n"
+                    f"• Today: {stats['today_sent']}\n\n"
+                    "Select an action:"
+                )
+                
+                buttons = [
+                    [Button.inline("➕ Add Group", f"add_group:{account_id}")],
+                    [Button.inline("📝 Add Message", f"add_msg:{account_id}")],
+                    [Button.inline("📋 View Groups", f"view_groups:{account_id}"),
+                     Button.inline("📄 View Messages", f"view_msgs:{account_id}")],
+                    [Button.inline("🚀 Send Now", f"send_now:{account_id}"),
+                     Button.inline("⚙️ Settings", f"settings:{account_id}")],
+                    [Button.inline("📊 Full Stats", f"stats:{account_id}")],
+                    [Button.inline("🔙 Back", "back_main")]
+                ]
+            else:
+                text = f"📱 **Account: {account_id}**\n\n❌ Not logged in yet"
+                buttons = [
+                    [Button.inline("🔐 Login", f"login:{account_id}")],
+                    [Button.inline("🔙 Back", "back_main")]
+                ]
             
-            buttons = [
-                [Button.inline("➕ Add Group", f"add_group:{account_id}")],
-                [Button.inline("📝 Add Message", f"add_msg:{account_id}")],
-                [Button.inline("📋 View Groups", f"view_groups:{account_id}"),
-                 Button.inline("📄 View Messages", f"view_msgs:{account_id}")],
-                [Button.inline("🚀 Send Now", f"send_now:{account_id}"),
-                 Button.inline("⚙️ Settings", f"settings:{account_id}")],
-                [Button.inline("📊 Full Stats", f"stats:{account_id}")],
-                [Button.inline("🔙 Back", "back_main")]
-            ]
-        else:
-            text = f"📱 **Account: {account_id}**\n\n❌ Not logged in yet"
-            buttons = [
-                [Button.inline("🔐 Login", f"login:{account_id}")],
-                [Button.inline("🔙 Back", "back_main")]
-            ]
-        
-        await event.edit(text, buttons=buttons)
+            await event.edit(text, buttons=buttons)
     
     # ==================== Login ====================
     async def start_login(self, event, account_id):
@@ -174,8 +174,8 @@ class BotHandlers:
         if success:
             # Save to database
             session_file = str(client.session.filename)
-            db = Database(account_path)
-            db.save_user(phone, session_file)
+            db = self.account_manager.get_async_database(account_id)
+            await db.save_user(phone, session_file)
             
             del self.user_states[user_id]
             
@@ -207,8 +207,8 @@ class BotHandlers:
         
         if success:
             session_file = str(client.session.filename)
-            db = Database(account_path)
-            db.save_user(phone, session_file)
+            db = self.account_manager.get_async_database(account_id)
+            await db.save_user(phone, session_file)
             
             del self.user_states[user_id]
             
@@ -221,10 +221,9 @@ class BotHandlers:
         """Start add group process"""
         user_id = event.sender_id
         
-        account_path = self.account_manager.get_account_path(account_id)
-        db = Database(account_path)
+        db = self.account_manager.get_async_database(account_id)
         
-        if not db.user_exists():
+        if not await db.user_exists():
             await event.answer("❌ Please login first", alert=True)
             return
         
@@ -245,89 +244,130 @@ class BotHandlers:
     
     async def process_group(self, event, user_id, account_id, group_link):
         """Process group addition"""
-        account_path = self.account_manager.get_account_path(account_id)
-        db = Database(account_path)
-        session_manager = await self.auto_sender.get_or_create_session(account_id, db)
-        
-        if not session_manager:
-            await event.reply("❌ Session not available. Please login again.")
-            del self.user_states[user_id]
-            return
-        
-        success, result = await session_manager.join_group(group_link)
-        
-        if success:
-            group_info = result
-            db.add_group(
-                group_link,
-                group_info['title'],
-                group_info['id'],
-                group_info['members_count']
-            )
+        with self.account_manager.pinned_database(account_id) as db:
+            # A disabled group goes through the join again and is re-enabled,
+            # one stored without its peer to record it
+            existing = await db.find_group(group_link)
+            if existing and existing[5] and existing[9] is not None:  # is_active, peer_type columns
+                await event.reply(
+                    f"ℹ️ **Group already added:** {existing[2]}",
+                    buttons=[Button.inline("🔙 Back", f"select:{account_id}")]
+                )
+                del self.user_states[user_id]
+                return
             
-            await event.reply(
-                f"✅ **Group Added**\n\n"
-                f"🏷️ **Name:** {group_info['title']}\n"
-                f"👥 **Members:** {group_info['members_count']:,}",
-                buttons=[Button.inline("🔙 Back", f"select:{account_id}")]
-            )
-        else:
-            await event.reply(f"❌ Error: {result}")
-        
-        del self.user_states[user_id]
+            # Held so another account's connect can't evict it mid-join
+            self.auto_sender.sessions.hold(account_id)
+            try:
+                session_manager = await self.auto_sender.get_or_create_session(account_id)
+                
+                if not session_manager:
+                    await event.reply("❌ Session not available. Please login again.")
+                    del self.user_states[user_id]
+                    return
+                
+                # The member count is shown and stored, so fetch it when the join lacks it
+                success, result = await session_manager.join_group(group_link, fetch_members=True)
+            finally:
+                self.auto_sender.sessions.release(account_id)
+            
+            if success:
+                group_info = result
+                added = await db.add_group(
+                    group_link,
+                    group_info['title'],
+                    group_info['id'],
+                    group_info['members_count'] or 0,
+                    group_info['access_hash'],
+                    group_info['peer_type']
+                )
+                
+                if added:
+                    text = (
+                        f"✅ **Group Added**\n\n"
+                        f"🏷️ **Name:** {group_info['title']}"
+                    )
+                    if group_info['members_count'] is not None:
+                        text += f"\n👥 **Members:** {group_info['members_count']:,}"
+                else:
+                    # add_group also fails on database errors; only a stored row
+                    # for the same chat (e.g. invite vs. username) is a duplicate
+                    existing = (await db.find_group_by_telegram_id(group_info['id'])
+                                or await db.find_group(group_link))
+                    if existing is not None and existing[9] is None and group_info['peer_type']:
+                        # Stored before peers were recorded (peer_type column);
+                        # the join just resolved the chat
+                        await db.update_group_peer(existing[0], group_info['access_hash'],
+                                                   group_info['peer_type'])
+                    if existing is None:
+                        text = "❌ Error saving group"
+                    elif existing[5]:
+                        text = f"ℹ️ **Group already added:** {existing[2]}"
+                    elif await db.update_group_status(existing[0], True):
+                        # Disabled, e.g. after repeated permanent send failures;
+                        # re-enabling also clears its failure streak
+                        text = f"✅ **Group Re-enabled:** {existing[2]}"
+                    else:
+                        text = "❌ Error re-enabling group"
+                await event.reply(
+                    text,
+                    buttons=[Button.inline("🔙 Back", f"select:{account_id}")]
+                )
+            else:
+                await event.reply(f"❌ Error: {result}")
+            
+            del self.user_states[user_id]
     
     # ==================== Add Message ====================
     async def start_add_message(self, event, account_id):
         """Start add message process"""
         user_id = event.sender_id
         
-        account_path = self.account_manager.get_account_path(account_id)
-        db = Database(account_path)
-        
-        if not db.user_exists():
-            await event.answer("❌ Please login first", alert=True)
-            return
-        
-        groups = db.get_groups()
-        if not groups:
-            await event.answer("❌ No groups added yet", alert=True)
-            return
-        
-        min_interval = db.get_setting('min_interval', '60')
-        max_interval = db.get_setting('max_interval', '90')
-        
-        self.user_states[user_id] = {
-            'state': 'awaiting_message',
-            'account_id': account_id
-        }
-        
-        await event.edit(
-            f"📝 **Add Message**\n\n"
-            f"⏰ Current interval: {min_interval}-{max_interval} minutes\n"
-            f"📊 Target groups: {len(groups)}\n\n"
-            "Send your message text:",
-            buttons=[Button.inline("🔙 Back", f"select:{account_id}")]
-        )
+        with self.account_manager.pinned_database(account_id) as db:
+            if not await db.user_exists():
+                await event.answer("❌ Please login first", alert=True)
+                return
+            
+            groups = await db.get_groups()
+            if not groups:
+                await event.answer("❌ No groups added yet", alert=True)
+                return
+            
+            min_interval = await db.get_setting('min_interval', '60')
+            max_interval = await db.get_setting('max_interval', '90')
+            
+            self.user_states[user_id] = {
+                'state': 'awaiting_message',
+                'account_id': account_id
+            }
+            
+            await event.edit(
+                f"📝 **Add Message**\n\n"
+                f"⏰ Current interval: {min_interval}-{max_interval} minutes\n"
+                f"📊 Target groups: {len(groups)}\n\n"
+                "Send your message text:",
+                buttons=[Button.inline("🔙 Back", f"select:{account_id}")]
+            )
     
     async def process_message(self, event, user_id, account_id, message_text):
         """Process message addition"""
-        account_path = self.account_manager.get_account_path(account_id)
-        db = Database(account_path)
-        
-        min_interval = int(db.get_setting('min_interval', '60'))
-        max_interval = int(db.get_setting('max_interval', '90'))
-        
-        if db.add_message(message_text, min_interval, max_interval):
-            await event.reply(
-                f"✅ **Message Added**\n\n"
-                f"⏰ Interval: {min_interval}-{max_interval} minutes\n"
-                f"📝 Will be sent automatically",
-                buttons=[Button.inline("🔙 Back", f"select:{account_id}")]
-            )
-        else:
-            await event.reply("❌ Error adding message")
-        
-        del self.user_states[user_id]
+        with self.account_manager.pinned_database(account_id) as db:
+            settings = await db.get_settings()
+            min_interval = settings.get('min_interval', 60)
+            max_interval = settings.get('max_interval', 90)
+            
+            if await db.add_message(message_text, min_interval, max_interval):
+                await self.auto_sender.refresh_schedule(account_id)
+                await event.reply(
+                    f"✅ **Message Added**\n\n"
+                    f"⏰ Interval: {min_interval}-{max_interval} minutes\n"
+                    f"📝 Will be sent automatically",
+                    buttons=[Button.inline("🔙 Back", f"select:{account_id}")]
+                )
+            else:
+                await event.reply("❌ Error adding message")
+            
+            del self.user_states[user_id]
     
     # ==================== Send Now ====================
     async def handle_send_now(self, event, account_id):
@@ -345,6 +385,9 @@ class BotHandlers:
                 f"• 📝 Messages: {result['messages_count']}\n"
                 f"• 👥 Groups: {result['groups_count']}"
             )
+            if result.get('paused_until'):
+                seconds = result['paused_until'] - time.time()
+                text += f"\n\n⏸ Stopped by a flood wait, resuming in {seconds:.0f}s"
         else:
             text = f"❌ **Error:** {result['message']}"
         
@@ -353,9 +396,8 @@ class BotHandlers:
     # ==================== Settings ====================
     async def show_settings(self, event, account_id):
         """Show settings menu"""
-        account_path = self.account_manager.get_account_path(account_id)
-        db = Database(account_path)
-        settings = db.get_all_settings()
+        db = self.account_manager.get_async_database(account_id)
+        settings = await db.get_all_settings()
         
         text = "⚙️ **Settings**\n\n"
         for key, value, description in settings:
@@ -372,28 +414,48 @@ class BotHandlers:
     # ==================== Statistics ====================
     async def show_stats(self, event, account_id):
         """Show full statistics"""
-        account_path = self.account_manager.get_account_path(account_id)
-        db = Database(account_path)
-        stats = db.get_total_stats()
-        
-        text = (
-            f"📊 **Full Statistics - {account_id}**\n\n"
-            f"📈 **Total:**\n"
-            f"• Messages Sent: {stats['total_sent']}\n"
-            f"• Active Groups: {stats['total_groups']}\n"
-            f"• Active Messages: {stats['total_messages']}\n\n"
-            f"📅 **Today:**\n"
-            f"• Sent: {stats['today_sent']}\n"
-            f"• Successful: {stats['today_successful']}\n"
-            f"• Failed: {stats['today_failed']}"
-        )
-        
-        buttons = [
-            [Button.inline("🔄 Refresh", f"stats:{account_id}")],
-            [Button.inline("🔙 Back", f"select:{account_id}")]
-        ]
-        
-        await event.edit(text, buttons=buttons)
+        with self.account_manager.pinned_database(account_id) as db:
+            stats = await db.get_total_stats()
+            
+            text = (
+                f"📊 **Full Statistics - {account_id}**\n\n"
+                f"📈 **Total:**\n"
+                f"• Messages Sent: {stats['total_sent']}\n"
+                f"• Active Groups: {stats['total_groups']}\n"
+                f"• Active Messages: {stats['total_messages']}\n\n"
+                f"📅 **Today:**\n"
+                f"• Sent: {stats['today_sent']}\n"
+                f"• Successful: {stats['today_successful']}\n"
+                f"• Failed: {stats['today_failed']}"
+            )
+            
+            daily = await db.get_daily_stats(days=7)
+            if daily:
+                text += "\n\n📆 **Last 7 Days:**\n"
+                for date, sent, successful, failed in daily:
+                    text += f"• {date}: {sent} (✅ {successful} / ❌ {failed})\n"
+            
+            # Busiest hour of day over the last week, in local time
+            by_hour = {}
+            for hour, sent, _, _ in await db.get_hourly_stats(hours=7 * 24):
+                hour_of_day = datetime.fromtimestamp(hour).hour
+                by_hour[hour_of_day] = by_hour.get(hour_of_day, 0) + sent
+            if by_hour:
+                peak_hour = max(by_hour, key=by_hour.get)
+                text += f"\n⏰ **Busiest Hour (7d):** {peak_hour:02d}:00 ({by_hour[peak_hour]} sent)"
+            
+            failures = await db.get_recent_failures(hours=24)
+            if failures:
+                text += "\n\n⚠️ **Failing Groups (24h):**\n"
+                for group_id, title, count, last_error in failures[:5]:
+                    text += f"• {title or group_id}: {count} ({last_error})\n"
+            
+            buttons = [
+                [Button.inline("🔄 Refresh", f"stats:{account_id}")],
+                [Button.inline("🔙 Back", f"select:{account_id}")]
+            ]
+            
+            await event.edit(text, buttons=buttons)
     
     # ==================== Message Router ====================
     async def handle_message(self, event):
@@ -4,11 +4,11 @@ Main entry point for the Telegram bot
 import asyncio
 import logging
 import signal
-import sys
 from telethon import TelegramClient, events
 from account_manager import AccountManager
 from auto_sender import AutoSender
 from handlers import BotHandlers
+from metrics import LoopLagMonitor, MetricsReporter
 import config
 
 # Setup logging
@@ -31,7 +31,16 @@ class TelegramBot:
         self.account_manager = AccountManager()
         self.auto_sender = AutoSender(self.account_manager)
         self.handlers = BotHandlers(self.account_manager, self.auto_sender)
+        self.auto_sender.notifier = self.notify_admin
+        self.loop_lag = LoopLagMonitor()
+        self.metrics = MetricsReporter({
+            'loop_lag': self.loop_lag.get_stats,
+            'auto_send': self.auto_sender.metrics.get_stats,
+            'session_pool': self.auto_sender.sessions.get_stats,
+            'db_cache': self.account_manager.get_db_cache_stats,
+        })
         self.running = False
+        self.stopped = False
     
     async def start(self):
         """Start the bot"""
@@ -50,8 +59,13 @@ class TelegramBot:
             me = await self.bot.get_me()
             logger.info(f"Bot username: @{me.username}")
             
+            # Report the SQLite profile of every account database, off the event loop
+            asyncio.create_task(self.account_manager.check_database_profiles())
+            
             # Start auto-sender
             self.running = True
+            self.loop_lag.start()
+            self.metrics.start()
             asyncio.create_task(self.auto_sender.start())
             
             # Keep running
@@ -61,6 +75,11 @@ class TelegramBot:
             logger.error(f"Error starting bot: {e}")
             raise
     
+    async def notify_admin(self, text: str):
+        """Send a notice to the admin"""
+        if self.bot:
+            await self.bot.send_message(config.ADMIN_USER_ID, text)
+    
     def register_handlers(self):
         """Register all event handlers"""
         
@@ -73,6 +92,18 @@ class TelegramBot:
                 logger.error(f"Error in start handler: {e}")
                 await event.reply("❌ An error occurred")
         
+        # Metrics command (admin only)
+        @self.bot.on(events.NewMessage(pattern='/metrics'))
+        async def metrics_handler(event):
+            try:
+                if event.sender_id != config.ADMIN_USER_ID:
+                    return
+                lines = [f"**{name}:** {stats}" for name, stats in self.metrics.collect().items()]
+                await event.reply("📈 **Metrics**\n\n" + "\n".join(lines))
+            except Exception as e:
+                logger.error(f"Error in metrics handler: {e}")
+                await event.reply("❌ An error occurred")
+        
         # Callback query handler
         @self.bot.on(events.CallbackQuery)
         async def callback_handler(event):
@@ -148,13 +179,24 @@ class TelegramBot:
     
     async def stop(self):
         """Stop the bot"""
+        if self.stopped:
+            return
+        self.stopped = True
         logger.info("Stopping bot...")
         self.running = False
         
+        # Final metrics, before the pool and the cache are emptied
+        self.metrics.stop()
+        self.loop_lag.stop()
+        self.metrics.log_stats()
+        
         # Stop auto-sender
         self.auto_sender.stop()
         await self.auto_sender.cleanup_all_sessions()
         
+        # Close cached account databases
+        self.account_manager.close_all_databases()
+        
         # Disconnect bot
         if self.bot:
             await self.bot.disconnect()
@@ -172,18 +214,30 @@ async def main():
     
     bot_instance = TelegramBot()
     
-    # Setup signal handlers
-    def signal_handler(sig, frame):
+    # Setup signal handlers; they only wake main() so stop() runs to the end
+    shutdown = asyncio.Event()
+    
+    def signal_handler():
         logger.info("Received shutdown signal")
-        if bot_instance:
-            asyncio.create_task(bot_instance.stop())
-        sys.exit(0)
+        shutdown.set()
     
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, signal_handler)
+    loop.add_signal_handler(signal.SIGTERM, signal_handler)
     
-    # Start bot
-    await bot_instance.start()
+    # Start bot and run until it disconnects or a signal arrives
+    bot_task = asyncio.create_task(bot_instance.start())
+    shutdown_task = asyncio.create_task(shutdown.wait())
+    try:
+        await asyncio.wait({bot_task, shutdown_task}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        shutdown_task.cancel()
+        await bot_instance.stop()
+    if bot_task.done():
+        # Surface an error from start()
+        await bot_task
+    else:
+        bot_task.cancel()
 
 
 if __name__ == '__main__':
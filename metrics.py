@@ -0,0 +1,120 @@
+"""
+Runtime metrics for the Telegram bot
+"""
+import asyncio
+import logging
+from typing import Callable, Dict, Optional
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from a fixed sleep"""
+    
+    def __init__(self, interval: float = config.LOOP_LAG_INTERVAL,
+                 warn_threshold: float = config.LOOP_LAG_WARN_THRESHOLD):
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self.task: Optional[asyncio.Task] = None
+        self.samples = 0
+        self.total_lag = 0.0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.slow_samples = 0
+    
+    def start(self):
+        """Start sampling in the background"""
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+    
+    def stop(self):
+        """Stop sampling"""
+        if self.task:
+            self.task.cancel()
+            self.task = None
+    
+    async def run(self):
+        """Sample loop lag forever"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.record(max(0.0, loop.time() - started - self.interval))
+    
+    def record(self, lag: float):
+        """Record one lag sample (seconds)"""
+        self.samples += 1
+        self.total_lag += lag
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        if lag >= self.warn_threshold:
+            self.slow_samples += 1
+            logger.warning(f"Event loop lag: {lag * 1000:.0f} ms")
+    
+    def get_stats(self) -> dict:
+        """Get lag statistics in milliseconds"""
+        return {
+            'samples': self.samples,
+            'last_ms': round(self.last_lag * 1000, 1),
+            'avg_ms': round(self.total_lag / self.samples * 1000, 1) if self.samples else 0.0,
+            'max_ms': round(self.max_lag * 1000, 1),
+            'slow_samples': self.slow_samples
+        }
+
+
+class SendMetrics:
+    """Counters of the auto-sender's rounds"""
+    
+    def __init__(self):
+        self.rounds = 0
+        self.stuck_rounds = 0
+    
+    def get_stats(self) -> dict:
+        """Get round counters"""
+        return {
+            'rounds': self.rounds,
+            'stuck_rounds': self.stuck_rounds
+        }
+
+
+class MetricsReporter:
+    """Logs the stats of several components every few minutes"""
+    
+    def __init__(self, sources: Dict[str, Callable[[], dict]],
+                 interval: float = config.METRICS_LOG_INTERVAL):
+        self.sources = sources
+        self.interval = interval
+        self.task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        """Start reporting in the background (never when the interval is 0)"""
+        if self.task is None and self.interval > 0:
+            self.task = asyncio.create_task(self.run())
+    
+    def stop(self):
+        """Stop reporting"""
+        if self.task:
+            self.task.cancel()
+            self.task = None
+    
+    async def run(self):
+        """Log the stats forever"""
+        while True:
+            await asyncio.sleep(self.interval)
+            self.log_stats()
+    
+    def collect(self) -> Dict[str, dict]:
+        """Get the current stats of every source"""
+        stats = {}
+        for name, get_stats in self.sources.items():
+            try:
+                stats[name] = get_stats()
+            except Exception as e:
+                logger.error(f"Error collecting {name} stats: {e}")
+        return stats
+    
+    def log_stats(self):
+        """Log one line per source"""
+        for name, stats in self.collect().items():
+            logger.info(f"Metrics {name}: {stats}")
@@ -0,0 +1,104 @@
+"""
+Deadline scheduler for the auto-sender
+"""
+import asyncio
+import heapq
+import logging
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SendScheduler:
+    """Min-heap of (next_send, account_id, message_id) across all accounts"""
+    
+    def __init__(self):
+        self._heap: List[Tuple[int, str, int]] = []
+        # Current deadline per message; heap entries that disagree are stale
+        self._deadlines: Dict[Tuple[str, int], int] = {}
+        self._wakeup = asyncio.Event()
+    
+    def __len__(self) -> int:
+        return len(self._deadlines)
+    
+    def schedule(self, account_id: str, message_id: int, next_send: int):
+        """Add or move a message deadline"""
+        key = (account_id, message_id)
+        if self._deadlines.get(key) == next_send:
+            return
+        
+        earliest = self.next_deadline()
+        self._deadlines[key] = next_send
+        heapq.heappush(self._heap, (next_send, account_id, message_id))
+        self._compact()
+        
+        if earliest is None or next_send < earliest:
+            self._wakeup.set()
+    
+    def unschedule(self, account_id: str, message_id: int):
+        """Forget a message deadline"""
+        self._deadlines.pop((account_id, message_id), None)
+    
+    def unschedule_account(self, account_id: str):
+        """Forget every deadline of an account"""
+        for key in [key for key in self._deadlines if key[0] == account_id]:
+            del self._deadlines[key]
+    
+    def set_account_schedule(self, account_id: str, entries: Iterable[Tuple[int, int]]):
+        """Replace an account's deadlines with (message_id, next_send) pairs"""
+        entries = dict(entries)
+        for key in [key for key in self._deadlines if key[0] == account_id]:
+            if key[1] not in entries:
+                del self._deadlines[key]
+        for message_id, next_send in entries.items():
+            self.schedule(account_id, message_id, next_send)
+    
+    def next_deadline(self) -> Optional[int]:
+        """Get the earliest pending deadline, if any"""
+        while self._heap:
+            next_send, account_id, message_id = self._heap[0]
+            if self._deadlines.get((account_id, message_id)) == next_send:
+                return next_send
+            heapq.heappop(self._heap)
+        return None
+    
+    def pop_due(self, now: Optional[float] = None) -> Dict[str, List[int]]:
+        """Remove and return due message ids grouped by account"""
+        if now is None:
+            now = time.time()
+        
+        due: Dict[str, List[int]] = {}
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None or deadline > now:
+                break
+            _, account_id, message_id = heapq.heappop(self._heap)
+            del self._deadlines[(account_id, message_id)]
+            due.setdefault(account_id, []).append(message_id)
+        return due
+    
+    async def wait_for_due(self):
+        """Sleep until the earliest deadline, an earlier schedule() or wake()"""
+        self._wakeup.clear()
+        deadline = self.next_deadline()
+        timeout = None if deadline is None else deadline - time.time()
+        if timeout is not None and timeout <= 0:
+            return
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    
+    def wake(self):
+        """Interrupt wait_for_due"""
+        self._wakeup.set()
+    
+    def _compact(self):
+        """Drop stale heap entries once they outnumber the live ones"""
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [
+                (next_send, account_id, message_id)
+                for (account_id, message_id), next_send in self._deadlines.items()
+            ]
+            heapq.heapify(self._heap)
@@ -4,21 +4,44 @@ Telegram session management
 import logging
 import hashlib
 import asyncio
+import time
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Union
 from telethon import TelegramClient
 from telethon.errors import (
     SessionPasswordNeededError, 
     FloodWaitError,
     PhoneCodeInvalidError,
-    PhoneCodeExpiredError
+    PhoneCodeExpiredError,
+    UserAlreadyParticipantError,
+    ChatWriteForbiddenError,
+    ChannelPrivateError,
+    UserBannedInChannelError,
+    ChatAdminRequiredError,
+    ChatRestrictedError,
+    ChannelInvalidError,
+    PeerIdInvalidError
 )
-from telethon.tl.functions.messages import ImportChatInviteRequest
-from telethon.tl.functions.channels import JoinChannelRequest
+from telethon.tl.functions.messages import CheckChatInviteRequest, ImportChatInviteRequest
+from telethon.tl.functions.channels import GetFullChannelRequest, JoinChannelRequest
+from telethon.tl.types import Channel, Chat, InputPeerChannel, InputPeerChat
+from group_links import INVITE, USERNAME, parse_group_link
 import config
 
 logger = logging.getLogger(__name__)
 
+# Send errors that retrying won't fix: the account was kicked or banned,
+# lost write access, or the chat is gone
+PERMANENT_SEND_ERRORS = frozenset(error.__name__ for error in (
+    ChatWriteForbiddenError,
+    ChannelPrivateError,
+    UserBannedInChannelError,
+    ChatAdminRequiredError,
+    ChatRestrictedError,
+    ChannelInvalidError,
+    PeerIdInvalidError
+))
+
 
 class SessionManager:
     """Manages Telegram sessions for an account"""
@@ -28,6 +51,16 @@ class SessionManager:
         self.sessions_dir = account_path / config.SESSION_DIR_NAME
         self.sessions_dir.mkdir(exist_ok=True)
         self.client: Optional[TelegramClient] = None
+        # Health check state
+        self.authorized_at = float('-inf')
+        self.reconnect_failures = 0
+        self.next_reconnect_at = 0.0
+        # Epoch time until which Telegram asked this account to stop sending
+        self.paused_until = 0.0
+        # Monotonic start time of the latest (or next reserved) send
+        self.last_send_at = float('-inf')
+        # Sends in a row that timed out; a stalled connection stops rounds
+        self.consecutive_timeouts = 0
     
     def get_session_path(self, phone: str) -> Path:
         """Get session file path for a phone number"""
@@ -49,21 +82,20 @@ class SessionManager:
                 return False
             
             self.client = TelegramClient(session_file, config.API_ID, config.API_HASH)
-            await self.client.connect()
+            await asyncio.wait_for(self.client.connect(), config.RPC_TIMEOUT)
             
-            if not await self.client.is_user_authorized():
+            if not await asyncio.wait_for(self.client.is_user_authorized(), config.RPC_TIMEOUT):
                 logger.warning("Session is not authorized")
                 await self.client.disconnect()
                 self.client = None
                 return False
             
+            self.authorized_at = time.monotonic()
             logger.info("Client initialized successfully")
             return True
         except Exception as e:
-            logger.error(f"Error initializing client: {e}")
-            if self.client:
-                await self.client.disconnect()
-                self.client = None
+            logger.error(f"Error initializing client: {e!r}")
+            await self.disconnect()
             return False
     
     async def send_code_request(self, phone: str) -> Tuple[bool, any]:
@@ -107,72 +139,158 @@ class SessionManager:
             logger.error(f"Error with password: {e}")
             return False, str(e)
     
-    async def join_group(self, group_link: str) -> Tuple[bool, any]:
-        """Join a Telegram group"""
+    async def join_group(self, group_link: str,
+                         fetch_members: bool = False) -> Tuple[bool, any]:
+        """Join a Telegram group
+        
+        Uses the chat returned by the join itself, so the common case is a
+        single request. members_count is None when the join result doesn't
+        carry it, unless fetch_members asks for an extra full-info request.
+        """
         if not self.client:
             return False, "Client not initialized"
         
+        link = parse_group_link(group_link)
+        if link is None:
+            return False, "Unrecognized group link"
+        
         try:
-            # Clean the link
-            link = group_link.replace('https://t.me/', '').replace('t.me/', '')
-            if link.startswith('@'):
-                link = link[1:]
-            
-            # Try to join
-            try:
-                result = await self.client(JoinChannelRequest(link))
-                entity = result.chats[0]
-            except Exception:
-                # Try with invite link
-                if '+' in link or 'joinchat' in link:
-                    invite_hash = link.split('/')[-1].replace('+', '')
-                    result = await self.client(ImportChatInviteRequest(invite_hash))
-                    entity = result.chats[0]
-                else:
-                    raise
+            if link.kind == INVITE:
+                try:
+                    result = await self._request(ImportChatInviteRequest(link.value))
+                    chat = result.chats[0]
+                except UserAlreadyParticipantError:
+                    # Already a member: the invite check returns the chat
+                    invite = await self._request(CheckChatInviteRequest(link.value))
+                    chat = invite.chat
+            elif link.kind == USERNAME:
+                # Joining a channel we're already in just returns it again
+                result = await self._request(JoinChannelRequest(link.value))
+                chat = result.chats[0]
+            else:
+                # Numeric ids can't be joined, only looked up among our chats
+                chat = await asyncio.wait_for(self.client.get_entity(link.value),
+                                              config.RPC_TIMEOUT)
             
-            # Get full entity info
-            full_entity = await self.client.get_entity(entity.id)
+            members_count = getattr(chat, 'participants_count', None)
+            if members_count is None and fetch_members and isinstance(chat, Channel):
+                members_count = await self.fetch_members_count(chat)
             
             return True, {
-                'title': full_entity.title,
-                'id': full_entity.id,
-                'members_count': getattr(full_entity, 'participants_count', 0)
+                'title': chat.title,
+                'id': chat.id,
+                'members_count': members_count,
+                **self.peer_info(chat)
             }
+        except asyncio.TimeoutError:
+            logger.error(f"Joining group timed out after {config.RPC_TIMEOUT}s")
+            return False, "Telegram did not respond in time"
         except Exception as e:
-            error_msg = str(e)
-            if "USER_ALREADY_PARTICIPANT" in error_msg:
-                try:
-                    entity = await self.client.get_entity(link)
-                    return True, {
-                        'title': entity.title,
-                        'id': entity.id,
-                        'members_count': getattr(entity, 'participants_count', 0)
-                    }
-                except:
-                    pass
             logger.error(f"Error joining group: {e}")
-            return False, error_msg
+            return False, str(e)
+    
+    async def fetch_members_count(self, channel: Channel) -> Optional[int]:
+        """Get a channel's member count from its full info, or None if that fails"""
+        try:
+            full = await self._request(GetFullChannelRequest(channel))
+            return full.full_chat.participants_count
+        except asyncio.TimeoutError:
+            logger.warning(f"Fetching members of {channel.title} timed out after {config.RPC_TIMEOUT}s")
+        except Exception as e:
+            logger.warning(f"Error fetching members of {channel.title}: {e}")
+        return None
+    
+    async def _request(self, request, timeout: float = config.RPC_TIMEOUT):
+        """Invoke a raw API request with a timeout"""
+        return await asyncio.wait_for(self.client(request), timeout)
+    
+    @staticmethod
+    def is_permanent_error(error_code: Optional[str]) -> bool:
+        """Check if a send error code means the group will keep refusing messages"""
+        return error_code in PERMANENT_SEND_ERRORS
+    
+    @staticmethod
+    def peer_info(entity) -> dict:
+        """Get the access_hash and peer_type to store for a joined chat or its input peer"""
+        if isinstance(entity, (Channel, InputPeerChannel)):
+            return {'access_hash': entity.access_hash, 'peer_type': 'channel'}
+        if isinstance(entity, (Chat, InputPeerChat)):
+            return {'access_hash': None, 'peer_type': 'chat'}
+        return {'access_hash': None, 'peer_type': None}
+    
+    async def resolve_peer(self, group_id: int) -> Optional[dict]:
+        """Resolve a stored chat id to the peer_info to store, or None if it fails"""
+        if not self.client:
+            return None
+        try:
+            peer = await asyncio.wait_for(self.client.get_input_entity(group_id),
+                                          config.RPC_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"Resolving chat {group_id} timed out after {config.RPC_TIMEOUT}s")
+            return None
+        except Exception as e:
+            logger.error(f"Error resolving chat {group_id}: {e}")
+            return None
+        info = self.peer_info(peer)
+        return info if info['peer_type'] else None
+    
+    @staticmethod
+    def input_peer(group: tuple) -> Union[int, InputPeerChannel, InputPeerChat]:
+        """Build the peer to send to from a groups row, without resolving it"""
+        group_id = group[3]  # group_id_telegram column
+        access_hash, peer_type = group[8], group[9]  # access_hash, peer_type columns
+        if peer_type == 'channel' and access_hash is not None:
+            return InputPeerChannel(channel_id=group_id, access_hash=access_hash)
+        if peer_type == 'chat':
+            return InputPeerChat(chat_id=group_id)
+        # Groups added before peers were stored; Telethon resolves the id
+        return group_id
     
     async def send_message(self, entity_id: int, message: str) -> bool:
         """Send a message to an entity"""
+        return await self.send_message_with_error(entity_id, message) is None
+    
+    async def send_message_with_error(self, entity_id: Union[int, InputPeerChannel, InputPeerChat],
+                                      message: str) -> Optional[str]:
+        """Send a message to an entity id or input peer and return None or the error code"""
         if not self.client:
-            return False
+            return 'NoClient'
         
         try:
-            await self.client.send_message(entity_id, message)
-            return True
+            await asyncio.wait_for(self.client.send_message(entity_id, message),
+                                   config.SEND_TIMEOUT)
+            self.consecutive_timeouts = 0
+            return None
         except FloodWaitError as e:
-            logger.warning(f"Flood wait: {e.seconds} seconds")
-            await asyncio.sleep(e.seconds)
-            return False
+            self.consecutive_timeouts = 0
+            # Don't sleep here; callers stop sending until paused_until
+            self.paused_until = max(self.paused_until, time.time() + e.seconds)
+            logger.warning(f"Flood wait: {e.seconds} seconds, pausing account")
+            return type(e).__name__
+        except asyncio.TimeoutError:
+            self.consecutive_timeouts += 1
+            logger.error(f"Sending message timed out after {config.SEND_TIMEOUT}s")
+            return 'TimeoutError'
         except Exception as e:
+            # Telegram answered, so the connection itself is alive
+            self.consecutive_timeouts = 0
             logger.error(f"Error sending message: {e}")
-            return False
+            return type(e).__name__
     
     async def send_to_multiple_groups(self, message: str, groups: list, 
-                                     delay: int = 2) -> Tuple[int, int]:
-        """Send message to multiple groups"""
+                                     delay: int = 2,
+                                     results: Optional[list] = None) -> Tuple[int, int]:
+        """Send message to multiple groups
+        
+        Sends start at least delay seconds apart, counted from the start of
+        the account's previous send (also across calls), with no wait after
+        the last group.
+        If results is given, (group row id, sent_at, latency_ms, error_code)
+        is appended for each group; error_code is None on success.
+        Stops early when the account gets a flood wait; the group that hit it
+        and the rest are neither counted nor added to results. Also stops
+        once the session is stalled (is_stalled()), leaving the rest unsent.
+        """
         if not self.client:
             return 0, len(groups)
         
@@ -180,33 +298,110 @@ class SessionManager:
         failed = 0
         
         for group in groups:
+            if self.is_paused() or self.is_stalled():
+                break
+            await self.pace(delay)
+            if self.is_paused():
+                break
+            sent_at = int(time.time())
+            started = time.monotonic()
+            error_code = None
             try:
-                group_id = group[3]  # group_id_telegram column
-                if await self.send_message(group_id, message):
-                    successful += 1
-                else:
-                    failed += 1
-                
-                # Delay between sends to avoid flood
-                if delay > 0:
-                    await asyncio.sleep(delay)
+                error_code = await self.send_message_with_error(self.input_peer(group), message)
             except Exception as e:
                 logger.error(f"Error sending to group {group[2]}: {e}")
+                error_code = type(e).__name__
+            latency_ms = int((time.monotonic() - started) * 1000)
+            
+            if self.is_paused():
+                # Retried once the flood wait is over
+                break
+            if error_code is None:
+                successful += 1
+            else:
                 failed += 1
+            if results is not None:
+                results.append((group[0], sent_at, latency_ms, error_code))
         
         return successful, failed
     
+    async def pace(self, interval: float):
+        """Wait for this account's next send slot, interval after the previous one"""
+        now = time.monotonic()
+        # Reserve the slot before sleeping so concurrent senders queue up
+        slot = max(now, self.last_send_at + interval)
+        self.last_send_at = slot
+        if slot > now:
+            await asyncio.sleep(slot - now)
+    
     async def disconnect(self):
         """Disconnect the client"""
         if self.client:
             try:
-                await self.client.disconnect()
+                # A half-open connection must not hang the caller
+                await asyncio.wait_for(self.client.disconnect(), config.SEND_TIMEOUT)
                 logger.info("Client disconnected")
             except Exception as e:
-                logger.error(f"Error disconnecting: {e}")
+                logger.error(f"Error disconnecting: {e!r}")
             finally:
                 self.client = None
     
     def is_connected(self) -> bool:
         """Check if client is connected"""
         return self.client is not None and self.client.is_connected()
+    
+    def is_paused(self) -> bool:
+        """Check if the account is waiting out a flood wait"""
+        return time.time() < self.paused_until
+    
+    def is_stalled(self) -> bool:
+        """Check if sends keep timing out, i.e. the connection is likely half-open"""
+        limit = config.SEND_MAX_CONSECUTIVE_TIMEOUTS
+        return limit > 0 and self.consecutive_timeouts >= limit
+    
+    def is_healthy(self) -> bool:
+        """Check if client is connected and its authorization was verified recently"""
+        return (self.is_connected() and
+                time.monotonic() - self.authorized_at < config.SESSION_AUTH_CHECK_TTL)
+    
+    async def ensure_connected(self) -> bool:
+        """Reconnect the existing client in place and re-check authorization if stale
+        
+        Failed reconnects back off exponentially; while backing off this
+        returns False without touching the network. If the session turns
+        out to be unauthorized the client is dropped (self.client is None).
+        """
+        if not self.client:
+            return False
+        if self.is_healthy():
+            return True
+        
+        now = time.monotonic()
+        if now < self.next_reconnect_at:
+            return False
+        
+        try:
+            if not self.client.is_connected():
+                await asyncio.wait_for(self.client.connect(), config.RPC_TIMEOUT)
+            if now - self.authorized_at >= config.SESSION_AUTH_CHECK_TTL:
+                if not await asyncio.wait_for(self.client.is_user_authorized(),
+                                              config.RPC_TIMEOUT):
+                    logger.warning("Session is no longer authorized")
+                    await self.disconnect()
+                    return False
+                self.authorized_at = time.monotonic()
+        except Exception as e:
+            self.reconnect_failures += 1
+            backoff = min(
+                config.SESSION_RECONNECT_BACKOFF_BASE * 2 ** (self.reconnect_failures - 1),
+                config.SESSION_RECONNECT_BACKOFF_MAX
+            )
+            self.next_reconnect_at = time.monotonic() + backoff
+            logger.warning(f"Reconnect failed ({e!r}), retrying in {backoff:.0f}s")
+            return False
+        
+        if self.reconnect_failures:
+            logger.info(f"Reconnected after {self.reconnect_failures} failed attempts")
+        self.reconnect_failures = 0
+        self.next_reconnect_at = 0.0
+        return True
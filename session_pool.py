@@ -0,0 +1,209 @@
+"""
+Pool of live Telegram sessions shared by the auto-sender and the bot handlers
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Set
+from session_manager import SessionManager
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class SessionPool:
+    """Bounded LRU pool of connected SessionManagers with idle disconnect"""
+    
+    def __init__(self, connect: Callable[[str], Awaitable[Optional[SessionManager]]],
+                 max_live: int = config.SESSION_POOL_MAX_LIVE,
+                 idle_timeout: float = config.SESSION_IDLE_TIMEOUT):
+        self.connect = connect
+        self.max_live = max_live
+        self.idle_timeout = idle_timeout
+        self.sessions: "OrderedDict[str, SessionManager]" = OrderedDict()
+        self.last_used: Dict[str, float] = {}
+        self.holds: Dict[str, int] = {}
+        # Held sessions to disconnect once their last hold is released
+        self.stale: Set[str] = set()
+        self.connecting: Dict[str, asyncio.Future] = {}
+        self.reaper_task: Optional[asyncio.Task] = None
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'joined': 0,
+            'reconnects': 0,
+            'backoffs': 0,
+            'connect_failures': 0,
+            'evicted': 0,
+            'idle_disconnects': 0,
+            'prewarmed': 0
+        }
+    
+    def start(self):
+        """Start disconnecting idle sessions in the background"""
+        if self.reaper_task is None and self.idle_timeout > 0:
+            self.reaper_task = asyncio.create_task(self.run_reaper())
+    
+    async def get(self, account_id: str) -> Optional[SessionManager]:
+        """Get a connected session for an account, connecting if needed"""
+        session_manager = self.sessions.get(account_id)
+        if session_manager is not None and session_manager.is_healthy():
+            self.stats['hits'] += 1
+            self._touch(account_id)
+            return session_manager
+        
+        # Single flight: concurrent callers share one reconnect/connect attempt
+        task = self.connecting.get(account_id)
+        if task is None:
+            task = asyncio.ensure_future(self._connect(account_id))
+            self.connecting[account_id] = task
+            task.add_done_callback(lambda _: self.connecting.pop(account_id, None))
+        else:
+            self.stats['joined'] += 1
+        # Shielded so a cancelled caller doesn't abort the others' connect
+        return await asyncio.shield(task)
+    
+    async def _connect(self, account_id: str) -> Optional[SessionManager]:
+        """Revive an account's pooled session, or connect a new one"""
+        session_manager = self.sessions.get(account_id)
+        if session_manager is not None:
+            if await session_manager.ensure_connected():
+                self.stats['reconnects'] += 1
+                self._touch(account_id)
+                return session_manager
+            if session_manager.client is not None:
+                # Reconnect failed; keep the client and let its backoff run
+                self.stats['backoffs'] += 1
+                return None
+            # Authorization was revoked; start over from the saved login
+            await self.discard(account_id)
+        
+        self.stats['misses'] += 1
+        try:
+            session_manager = await self.connect(account_id)
+        except Exception as e:
+            logger.error(f"Error connecting session for {account_id}: {e}")
+            session_manager = None
+        
+        if session_manager is None:
+            self.stats['connect_failures'] += 1
+            return None
+        
+        self.sessions[account_id] = session_manager
+        self._touch(account_id)
+        await self._evict(keep=account_id)
+        return session_manager
+    
+    async def prewarm(self, account_id: str):
+        """Connect an account ahead of its next deadline"""
+        session_manager = self.sessions.get(account_id)
+        if (session_manager is not None and session_manager.is_healthy()) or \
+                account_id in self.connecting:
+            return
+        if await self.get(account_id):
+            self.stats['prewarmed'] += 1
+            logger.info(f"Pre-warmed session for {account_id}")
+    
+    def hold(self, account_id: str):
+        """Protect an account's session from eviction while it is in use"""
+        self.holds[account_id] = self.holds.get(account_id, 0) + 1
+    
+    def release(self, account_id: str):
+        """Release a hold taken with hold()"""
+        count = self.holds.get(account_id, 0) - 1
+        if count > 0:
+            self.holds[account_id] = count
+        else:
+            self.holds.pop(account_id, None)
+            if account_id in self.stale:
+                self._drop(account_id)
+                return
+        if account_id in self.sessions:
+            self._touch(account_id)
+    
+    def recycle(self, account_id: str):
+        """Reconnect an account's session once nobody is using it
+        
+        Unlike discard(), this doesn't pull the client from under a
+        concurrent holder (e.g. a Send Now still running); the session is
+        dropped when its last hold is released and the next get() connects
+        a fresh one.
+        """
+        if account_id not in self.sessions:
+            return
+        if account_id in self.holds:
+            self.stale.add(account_id)
+        else:
+            self._drop(account_id)
+    
+    async def discard(self, account_id: str):
+        """Disconnect and forget an account's session"""
+        session_manager = self.sessions.pop(account_id, None)
+        self.last_used.pop(account_id, None)
+        self.stale.discard(account_id)
+        if session_manager is not None:
+            await session_manager.disconnect()
+    
+    async def close_all(self):
+        """Disconnect every session"""
+        if self.reaper_task:
+            self.reaper_task.cancel()
+            self.reaper_task = None
+        for account_id in list(self.sessions):
+            await self.discard(account_id)
+    
+    async def reap_idle(self):
+        """Disconnect sessions unused for longer than the idle timeout"""
+        cutoff = time.monotonic() - self.idle_timeout
+        for account_id in list(self.sessions):
+            if account_id in self.holds or self.last_used.get(account_id, 0) > cutoff:
+                continue
+            await self.discard(account_id)
+            self.stats['idle_disconnects'] += 1
+            logger.info(f"Disconnected idle session for {account_id}")
+    
+    async def run_reaper(self):
+        """Reap idle sessions periodically"""
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 2, 1))
+            try:
+                await self.reap_idle()
+            except Exception as e:
+                logger.error(f"Error reaping idle sessions: {e}")
+    
+    def get_stats(self) -> dict:
+        """Get pool counters"""
+        return {
+            'live': len(self.sessions),
+            'connecting': len(self.connecting),
+            'held': len(self.holds),
+            'max_live': self.max_live,
+            **self.stats
+        }
+    
+    def _drop(self, account_id: str):
+        """Forget a session right away and disconnect it in the background"""
+        session_manager = self.sessions.pop(account_id, None)
+        self.last_used.pop(account_id, None)
+        self.stale.discard(account_id)
+        if session_manager is not None:
+            asyncio.create_task(session_manager.disconnect())
+    
+    def _touch(self, account_id: str):
+        """Mark a session as most recently used"""
+        self.sessions.move_to_end(account_id)
+        self.last_used[account_id] = time.monotonic()
+    
+    async def _evict(self, keep: Optional[str] = None):
+        """Disconnect least recently used sessions beyond max_live"""
+        excess = len(self.sessions) - self.max_live
+        for account_id in list(self.sessions):
+            if excess <= 0:
+                break
+            if account_id in self.holds or account_id == keep:
+                continue
+            await self.discard(account_id)
+            self.stats['evicted'] += 1
+            excess -= 1
+            logger.info(f"Evicted session for {account_id}")